@@ -15,16 +15,18 @@ def slugify(text):
     text = re.sub(r"\s+", "-", text)
     return text
 
-def hash_product(prod, keys):
+def hash_product(prod, keys, site_name=""):
+    """
+    Stable identity for an API product: site + product id, or site + title when there is no id.
+    Stock and preorder flags are state, not identity, and must not be part of the key.
+    """
     h = hashlib.sha256()
-    if "api_id_key" in keys and keys["api_id_key"]:
-        h.update(str(deep_get(prod, keys["api_id_key"])).encode())
-    if "api_title_key" in keys and keys["api_title_key"]:
-        h.update(str(deep_get(prod, keys["api_title_key"])).encode())
-    if "api_stock_key" in keys and keys["api_stock_key"]:
-        h.update(str(deep_get(prod, keys["api_stock_key"])).encode())
-    if "api_preorder_key" in keys and keys["api_preorder_key"]:
-        h.update(str(deep_get(prod, keys["api_preorder_key"])).encode())
+    h.update(site_name.strip().lower().encode())
+    prod_id = deep_get(prod, keys["api_id_key"]) if keys.get("api_id_key") else None
+    if prod_id is not None:
+        h.update(b"|id|" + str(prod_id).encode())
+    else:
+        h.update(b"|title|" + str(deep_get(prod, keys.get("api_title_key"))).encode())
     return h.hexdigest()
 
 def deep_get(data, key_path):
@@ -91,16 +93,15 @@ def get_api_products(site_conf):
                 prod_hash = hash_product(prod, {
                     "api_id_key": id_key,
                     "api_title_key": title_key,
-                    "api_stock_key": stock_key,
-                    "api_preorder_key": preorder_key,
-                })
+                }, site_name)
                 products.append({
                     "hash": prod_hash,
                     "name": name,
                     "url": prod_url,
                     "price": price,
                     "status": status,
-                    "site_name": site_name
+                    "site_name": site_name,
+                    "source": "api"
                 })
         except Exception as e:
             print(f"[API ERROR] Failed to fetch {url}: {e}")
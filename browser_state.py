@@ -0,0 +1,105 @@
+import json
+import os
+from urllib.parse import urlparse
+
+DATA_DIR = "data"
+STORAGE_STATE_DIR = os.path.join(DATA_DIR, "storage_state")
+COOKIE_BANNERS_FILE = os.path.join(DATA_DIR, "cookie_banners.json")
+
+BANNER_MISS_LIMIT = 2  # antal körningar utan banner innan vi slutar vänta på den
+
+# domän -> Playwright storage state (cookies + localStorage), delas mellan alla kontexter i körningen
+_storage_states = {}
+_banner_knowledge = None
+# Domäner där bannern uteblivit i den här körningen: en körning räknas som en miss, inte varje URL
+_missed_this_run = set()
+
+
+def domain_of(url):
+    netloc = urlparse(url).netloc.lower()
+    return netloc[4:] if netloc.startswith("www.") else netloc
+
+
+def _state_path(domain):
+    safe = "".join(c if c.isalnum() or c in ".-" else "_" for c in domain)
+    return os.path.join(STORAGE_STATE_DIR, f"{safe}.json")
+
+
+def get_storage_state(domain):
+    """Returnerar sparad storage state för domänen, eller None om ingen finns."""
+    if domain in _storage_states:
+        return _storage_states[domain]
+    path = _state_path(domain)
+    state = None
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"[STATE] Kunde inte läsa {path}: {e}", flush=True)
+    _storage_states[domain] = state
+    return state
+
+
+async def save_storage_state(context, domain):
+    """Fångar kontextens cookies/localStorage och sparar dem för senare kontexter och körningar."""
+    try:
+        state = await context.storage_state()
+    except Exception as e:
+        print(f"[STATE] Kunde inte hämta storage state för {domain}: {e}", flush=True)
+        return
+    _storage_states[domain] = state
+    os.makedirs(STORAGE_STATE_DIR, exist_ok=True)
+    with open(_state_path(domain), "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+
+
+async def new_site_context(browser, url, user_agent):
+    """Ny browser-kontext för URL:en, förladdad med domänens sparade session om en sådan finns."""
+    state = get_storage_state(domain_of(url))
+    if state:
+        return await browser.new_context(user_agent=user_agent, storage_state=state)
+    return await browser.new_context(user_agent=user_agent)
+
+
+def _load_banner_knowledge():
+    global _banner_knowledge
+    if _banner_knowledge is None:
+        _banner_knowledge = {}
+        if os.path.exists(COOKIE_BANNERS_FILE):
+            with open(COOKIE_BANNERS_FILE, "r", encoding="utf-8") as f:
+                _banner_knowledge = json.load(f)
+    return _banner_knowledge
+
+
+def should_wait_for_banner(site, domain):
+    """
+    Avgör om det är värt att vänta på cookie-bannern.
+    Sitens 'cookie_banner'-flagga vinner; annars används sparad session och vad vi lärt oss tidigare.
+    """
+    flag = site.get("cookie_banner")
+    if flag is False:
+        return False
+    if get_storage_state(domain):
+        return False
+    if flag is True:
+        return True
+    entry = _load_banner_knowledge().get(domain, {})
+    return entry.get("seen", 0) > 0 or entry.get("missed", 0) < BANNER_MISS_LIMIT
+
+
+def record_banner(domain, seen):
+    entry = _load_banner_knowledge().setdefault(domain, {"seen": 0, "missed": 0})
+    if seen:
+        entry["seen"] += 1
+    elif domain not in _missed_this_run:
+        _missed_this_run.add(domain)
+        entry["missed"] += 1
+
+
+def save_banner_knowledge():
+    if _banner_knowledge is None:
+        return
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(COOKIE_BANNERS_FILE, "w", encoding="utf-8") as f:
+        json.dump(_banner_knowledge, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,105 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEBUG_DIR = "debug_artifacts"
+OBJECTS_DIR = os.path.join(DEBUG_DIR, "objects")
+INDEX_FILE = os.path.join(DEBUG_DIR, "index.jsonl")
+
+MAX_TOTAL_BYTES = 200 * 1024 * 1024  # komprimerad storlek för alla sparade sidor
+MAX_AGE_DAYS = 14
+
+RUN_ID = os.getenv("GITHUB_RUN_ID") or time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+
+# En skrivtråd: komprimering och disk-I/O håller sig borta från event-loopen och index-filen skrivs i ordning
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="debug-artifacts")
+_pending = set()
+
+
+def _object_path(digest):
+    return os.path.join(OBJECTS_DIR, digest[:2], f"{digest}.html.gz")
+
+
+def _write(kind, site, url, content, created):
+    data = content.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    path = _object_path(digest)
+    if os.path.exists(path):
+        # Samma felsida har redan sparats: räcker att förnya åldern
+        os.utime(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with gzip.open(tmp, "wb", compresslevel=6) as f:
+            f.write(data)
+        os.replace(tmp, path)
+    entry = {
+        "run": RUN_ID,
+        "time": created,
+        "kind": kind,
+        "site": site,
+        "url": url,
+        "sha256": digest,
+        "bytes": len(data),
+        "stored_bytes": os.path.getsize(path),
+    }
+    with open(INDEX_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    return path
+
+
+def save(kind, site, url, content):
+    """
+    Sparar en sidas HTML i bakgrunden (t.ex. kind='timeout' eller 'zero_products').
+    Returnerar direkt; flush() väntar in alla skrivningar.
+    """
+    if not content:
+        return
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_executor, _write, kind, site, url, content, time.time())
+    _pending.add(future)
+    future.add_done_callback(_done)
+
+
+def _done(future):
+    _pending.discard(future)
+    if not future.cancelled() and future.exception() is not None:
+        print(f"[DEBUG] Kunde inte spara debug-sida: {future.exception()}", flush=True)
+
+
+def _evict():
+    if not os.path.isdir(OBJECTS_DIR):
+        return
+    blobs = []
+    for root, _, files in os.walk(OBJECTS_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            blobs.append((stat.st_mtime, stat.st_size, path))
+    cutoff = time.time() - MAX_AGE_DAYS * 86400
+    blobs.sort()
+    total = sum(size for _, size, _ in blobs)
+    removed = set()
+    for mtime, size, path in blobs:
+        if mtime >= cutoff and total <= MAX_TOTAL_BYTES:
+            break
+        os.remove(path)
+        total -= size
+        removed.add(os.path.basename(path).split(".", 1)[0])
+    if removed and os.path.exists(INDEX_FILE):
+        with open(INDEX_FILE, "r", encoding="utf-8") as f:
+            lines = [line for line in f if line.strip() and json.loads(line)["sha256"] not in removed]
+        with open(INDEX_FILE, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        print(f"[DEBUG] Rensade {len(removed)} gamla debug-sidor.", flush=True)
+
+
+async def flush():
+    """Väntar in pågående skrivningar och rensar sedan efter ålder och total storlek."""
+    if _pending:
+        await asyncio.gather(*list(_pending), return_exceptions=True)
+    await asyncio.get_running_loop().run_in_executor(_executor, _evict)
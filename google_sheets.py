@@ -4,6 +4,9 @@ from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from datetime import datetime
 import ast
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 import gspread
 
 # Läs in JSON-credentials från secret
@@ -24,6 +27,10 @@ if not SPREADSHEET_ID:
     raise Exception("Miljövariabeln GOOGLE_SHEETS_ID är inte satt")
 
 SHEET_NAME = 'Blad1'  # Ändra till ditt ark-namn om det behövs
+SHEETS_NUM_RETRIES = 5  # googleapiclient backar av exponentiellt vid 429/5xx (kvotfel)
+
+# httplib2 är inte trådsäkert: alla anrop går via en och samma tråd som återanvänder service-anslutningen
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="google-sheets")
 
 
 def get_all_hashes():
@@ -32,7 +39,7 @@ def get_all_hashes():
     """
     sheet = service.spreadsheets()
     range_ = f'{SHEET_NAME}!G2:G'  # Anta att första raden är header, börja på rad 2
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=range_).execute()
+    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=range_).execute(num_retries=SHEETS_NUM_RETRIES)
     values = result.get('values', [])
     hashes = [row[0] for row in values if row]  # Säkerställ att raden inte är tom
     return hashes
@@ -43,11 +50,23 @@ def get_all_hashes_with_row_indices():
     """
     sheet = service.spreadsheets()
     range_ = f'{SHEET_NAME}!G2:G'
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=range_).execute()
+    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=range_).execute(num_retries=SHEETS_NUM_RETRIES)
     values = result.get('values', [])
     # row_index is 1-based, so +2
     return [(i + 2, row[0]) for i, row in enumerate(values) if row]
 
+def _delete_row_request(row_index):
+    return {
+        "deleteDimension": {
+            "range": {
+                "sheetId": 0,  # OBS: Kolla sheetId! Om du inte vet, kan du behöva hämta det från Sheets API
+                "dimension": "ROWS",
+                "startIndex": row_index - 1,  # 0-baserat index i API
+                "endIndex": row_index
+            }
+        }
+    }
+
 def deduplicate_sheet_hashes():
     """
     Removes duplicate rows for the same hash in Google Sheets, keeping only the first occurrence.
@@ -65,21 +84,9 @@ def deduplicate_sheet_hashes():
     print(f"[INFO] Removing {len(duplicates)} duplicate rows from Google Sheets: {duplicates}")
     # Sort in reverse so row numbers don't shift
     duplicates.sort(reverse=True)
-    for row_index in duplicates:
-        request_body = {
-            "requests": [{
-                "deleteDimension": {
-                    "range": {
-                        "sheetId": 0,  # adjust if needed!
-                        "dimension": "ROWS",
-                        "startIndex": row_index - 1,
-                        "endIndex": row_index
-                    }
-                }
-            }]
-        }
-        service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=request_body).execute()
-        time.sleep(1)  # To avoid quota
+    # One batchUpdate with all deletions instead of one request (and one sleep) per row
+    request_body = {"requests": [_delete_row_request(row_index) for row_index in duplicates]}
+    service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=request_body).execute(num_retries=SHEETS_NUM_RETRIES)
 
 def update_row(row_index, row_data):
     """
@@ -95,7 +102,7 @@ def update_row(row_index, row_data):
         valueInputOption='RAW',
         body=body
     )
-    response = request.execute()
+    response = request.execute(num_retries=SHEETS_NUM_RETRIES)
     return response
 
 
@@ -107,7 +114,7 @@ def append_row(row_data):
     sheet = service.spreadsheets()
 
     # Läs in alla värden i kolumn A (från rad 1 och neråt)
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=f'{SHEET_NAME}!A:A').execute()
+    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=f'{SHEET_NAME}!A:A').execute(num_retries=SHEETS_NUM_RETRIES)
     values = result.get('values', [])
 
     # Nästa rad är antal rader med innehåll + 1 (eftersom Sheets är 1-baserat)
@@ -123,7 +130,7 @@ def append_row(row_data):
         valueInputOption='RAW',
         body=body
     )
-    response = request.execute()
+    response = request.execute(num_retries=SHEETS_NUM_RETRIES)
     return response
 
 def update_or_append_rows(products_data):
@@ -182,7 +189,7 @@ def update_or_append_rows(products_data):
             'valueInputOption': 'RAW',
             'data': data
         }
-        response = sheet.values().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=body).execute()
+        response = sheet.values().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=body).execute(num_retries=SHEETS_NUM_RETRIES)
         print(f"[INFO] Uppdaterade {len(updates)} rader i Google Sheets.")
 
     # Lägg till nya rader i slutet
@@ -193,7 +200,7 @@ def update_or_append_rows(products_data):
             valueInputOption='RAW',
             insertDataOption='INSERT_ROWS',
             body={'values': appends}
-        ).execute()
+        ).execute(num_retries=SHEETS_NUM_RETRIES)
         print(f"[INFO] La till {len(appends)} nya rader i Google Sheets.")
 
 def delete_rows_with_missing_hashes(available_products):
@@ -205,7 +212,7 @@ def delete_rows_with_missing_hashes(available_products):
 
     # Läs in hela kolumn G, men också radnummer för att kunna ta bort rätt rad
     range_ = f'{SHEET_NAME}!G2:G'
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=range_).execute()
+    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=range_).execute(num_retries=SHEETS_NUM_RETRIES)
     values = result.get('values', [])
 
     # Vi behöver en lista med (row_index, hash)
@@ -224,21 +231,30 @@ def delete_rows_with_missing_hashes(available_products):
     # Viktigt: Radera från botten till toppen så att radnumren inte skiftar när vi tar bort flera
     rows_to_delete.sort(reverse=True)
 
-    for row_index in rows_to_delete:
-        request_body = {
-            "requests": [{
-                "deleteDimension": {
-                    "range": {
-                        "sheetId": 0,  # OBS: Kolla sheetId! Om du inte vet, kan du behöva hämta det från Sheets API
-                        "dimension": "ROWS",
-                        "startIndex": row_index - 1,  # 0-baserat index i API
-                        "endIndex": row_index
-                    }
-                }
-            }]
-        }
-        response = service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=request_body).execute()
-        print(f"[INFO] Tog bort rad {row_index} i Google Sheets.")
+    # Alla borttagningar i ett enda batchUpdate-anrop; de utförs i ordning, nedifrån och upp
+    request_body = {"requests": [_delete_row_request(row_index) for row_index in rows_to_delete]}
+    service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=request_body).execute(num_retries=SHEETS_NUM_RETRIES)
+    print(f"[INFO] Tog bort {len(rows_to_delete)} rader i Google Sheets.")
+
+
+def sync_products(products_data, available_products):
+    """Hela Sheets-uppdateringen efter en körning: rensa dubbletter, uppdatera/lägg till, ta bort försvunna."""
+    started = time.time()
+    deduplicate_sheet_hashes()
+    update_or_append_rows(products_data)
+    delete_rows_with_missing_hashes(available_products)
+    print(f"[INFO] Google Sheets synkat på {time.time() - started:.1f} sekunder.")
+
+
+async def sync_products_async(products_data, available_products):
+    """
+    Kör sync_products på Sheets-tråden så att event-loopen (och Discord-utskicket) inte blockeras.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(_executor, sync_products, list(products_data), dict(available_products))
+    except Exception as e:
+        print(f"[ERROR] Google Sheets-synk misslyckades: {e}", flush=True)
 
 
 def convert_value(val):
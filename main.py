@@ -1,6 +1,7 @@
 import asyncio
-import aiohttp
+import copy
 import os
+import sys
 import json
 import hashlib
 from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
@@ -11,6 +12,15 @@ import requests
 from urllib.parse import urlparse, urlunparse
 import google_sheets
 from api_scraper import get_api_products
+import run_planner
+import browser_state
+import subscriptions
+import rate_controller
+import sitemap_discovery
+import watchlist
+import debug_artifacts
+import product_state
+import product_matching
 
 DATA_DIR = "data"
 SEEN_PRODUCTS_FILE = os.path.join(DATA_DIR, "seen_products.json")
@@ -27,8 +37,9 @@ USER_AGENT = (
     "Chrome/114.0.0.0 Safari/537.36 Edg/114.0.1823.43"
 )
 
-PARALLEL_URLS_PER_SITE = 3  # Lowered: avoid bot detection
+PARALLEL_SITES = 4  # Sites run in planned order, this many at a time
 GLOBAL_SCRIPT_TIMEOUT = 5400
+WATCHLIST_ONLY_DURATION = 3000  # python main.py --watchlist [seconds]
 SITE_TIMEOUT = 3000
 
 KEYWORDS = [
@@ -40,6 +51,13 @@ BLOCKED_KEYWORDS = [
     "Stacking Tin", "Mugg", "Ryggsäck", "Stort kort", "Ultra Pro", "Suddgummi", "Guiden"
 ]
 
+SUBSCRIPTION_INDEX = subscriptions.SubscriptionIndex(subscriptions.load_subscriptions(
+    default=subscriptions.default_subscription(DISCORD_WEBHOOK, KEYWORDS, BLOCKED_KEYWORDS)
+))
+
+# Browser sites still key products by site|name, so those keys must never be taken over by an API product
+BROWSER_SITE_NAMES = set()
+
 def load_json(file_path):
     if os.path.exists(file_path):
         with open(file_path, "r", encoding="utf-8") as f:
@@ -84,26 +102,45 @@ def safe_int(value, default=1):
     except (ValueError, TypeError):
         return default
 
-async def dismiss_cookies(page):
+COOKIE_ACCEPT_SELECTOR = "#cc-b-acceptall, #ac-acceptall"
+
+async def click_cookie_accept(page):
+    if await page.is_visible("#cc-b-acceptall"):
+        await page.click("#cc-b-acceptall")
+    elif await page.is_visible("#ac-acceptall"):
+        await page.click("#ac-acceptall")
+    else:
+        return False
+    return True
+
+async def dismiss_cookies(page, site):
+    domain = browser_state.domain_of(page.url)
     try:
-        # Wait for either button to appear
-        await page.wait_for_selector("#cc-b-acceptall, #ac-acceptall", timeout=5000)
-        if await page.is_visible("#cc-b-acceptall"):
-            await page.click("#cc-b-acceptall")
-        elif await page.is_visible("#ac-acceptall"):
-            await page.click("#ac-acceptall")
-        await asyncio.sleep(1)
+        if not browser_state.should_wait_for_banner(site, domain):
+            # Consent already stored or no banner expected: only a quick check, no waiting
+            if await click_cookie_accept(page):
+                await browser_state.save_storage_state(page.context, domain)
+            return
+        try:
+            # Wait for either button to appear
+            await page.wait_for_selector(COOKIE_ACCEPT_SELECTOR, timeout=5000)
+        except PlaywrightTimeoutError:
+            browser_state.record_banner(domain, seen=False)
+            return
+        if await click_cookie_accept(page):
+            browser_state.record_banner(domain, seen=True)
+            await asyncio.sleep(1)
+            await browser_state.save_storage_state(page.context, domain)
     except Exception:
         pass
 
-async def send_discord_message(name, url, price, status, site_name):
-    if not DISCORD_WEBHOOK:
-        print("No Discord webhook set in environment variable.", flush=True)
-        return
-
+def build_discord_payload(notif):
+    name, url, price, status, site_name = (
+        notif["name"], notif["url"], notif["price"], notif["status"], notif["site_name"]
+    )
     if not name or not url or not status:
         print(f"[DISCORD] Skipping message due to missing required field: name={name}, url={url}, status={status}")
-        return
+        return None
 
     price_str = str(price) if price else "Okänt"
     color_map = {
@@ -124,24 +161,84 @@ async def send_discord_message(name, url, price, status, site_name):
         ],
         "footer": {"text": "Skynda att köpa innan den tar slut!"}
     }
-    payload = {"embeds": [embed]}
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(DISCORD_WEBHOOK, json=payload) as response:
-                if response.status != 204:
-                    text = await response.text()
-                    print(f"Failed to send Discord message: {response.status} {text}", flush=True)
-                await asyncio.sleep(1.5)
-        except Exception as e:
-            print(f"Exception while sending Discord message: {e}", flush=True)
+    offers = notif.get("offers") or []
+    if len(offers) > 1:
+        # Same product in several stores, cheapest first
+        lines = [
+            f"[{capitalize_first(o['site_name'])}]({o['url']}): {o['price'] or 'Okänt'} ({o['status']})"
+            for o in offers
+        ]
+        value = ""
+        for line in lines:
+            if len(value) + len(line) + 1 > 1024:  # Discord field limit
+                break
+            value += line + "\n"
+        embed["fields"].append({"name": "Butiker", "value": value.strip(), "inline": False})
+    return {"embeds": [embed]}
 
-def product_matches_keywords(name):
+async def post_discord_payload(session, webhook, payload):
+    try:
+        async with session.post(webhook, json=payload) as response:
+            if response.status != 204:
+                text = await response.text()
+                print(f"Failed to send Discord message: {response.status} {text}", flush=True)
+                return False
+            return True
+    except Exception as e:
+        print(f"Exception while sending Discord message: {e}", flush=True)
+        return False
+
+def detect_change(prod, seen_products, available_products, unfiltered_sites):
+    """
+    Compares a scraped product with the saved state, updates the state in place
+    and returns the notification to send, or None if nothing changed.
+    """
+    skip_keywords = run_planner.site_key({"name": prod["site_name"]}) in unfiltered_sites
+    entry = seen_products.get(prod["hash"])
+    if entry is None:
+        # Same product already known under another key: sitemap page vs listing, or a legacy entry
+        reserved = {generate_product_hash(prod["name"], site_name) for site_name in BROWSER_SITE_NAMES}
+        entry = product_state.adopt_by_url(seen_products, available_products, prod) or \
+            product_state.adopt_legacy(seen_products, available_products, prod, reserved)
+    prod_hash = prod["hash"]
+    if entry is None:
+        seen_products[prod_hash] = product_state.new_entry(prod)
+        return {
+            "hash": prod_hash,
+            "name": prod["name"],
+            "url": prod["url"],
+            "price": prod["price"],
+            "status": "Ny produkt",
+            "site_name": prod["site_name"],
+            "skip_keywords": skip_keywords
+        }
+    # A status change (e.g. preorder -> in stock) is news even if the product never left available_products
+    state_changed = product_state.touch(entry, prod)
+    if prod["status"] in ("i lager", "förbeställningsbar", "Tillbaka i lager", "Förbeställningsbar") and \
+            (prod_hash not in available_products or state_changed):
+        available_products[prod_hash] = prod["name"]
+        return {
+            "hash": prod_hash,
+            "name": prod["name"],
+            "url": prod["url"],
+            "price": prod["price"],
+            # Listings say "i lager"; the watchlist and product pages already say "Tillbaka i lager"
+            "status": "Tillbaka i lager" if prod["status"].lower() in ("i lager", "tillbaka i lager") else "Förbeställningsbar",
+            "site_name": prod["site_name"],
+            "skip_keywords": skip_keywords
+        }
+    return None
+
+def matches_global_keywords(name):
     name_lower = name.lower()
-    for blocked in BLOCKED_KEYWORDS:
-        if blocked.lower() in name_lower:
-            return False
+    if any(blocked.lower() in name_lower for blocked in BLOCKED_KEYWORDS):
+        return False
     return any(re.search(keyword, name, re.IGNORECASE) for keyword in KEYWORDS)
 
+def product_matches_keywords(name, site_name=None):
+    # Keep products a subscriber watching this site asked for by keyword, even outside the global keywords
+    return matches_global_keywords(name) or SUBSCRIPTION_INDEX.matches_keywords(name, site_name)
+
 def get_urls_to_scrape(site):
     if "url_pattern" in site and site["url_pattern"]:
         start = safe_int(site.get("start_page", 1))
@@ -270,167 +367,515 @@ async def check_if_preorderable(product_url, product_page, site):
     finally:
         print(f"Preorder-check klar på {time.time()-start_pre:.2f} sek", flush=True)
 
-async def scrape_url(url, site, browser):
+async def extract_products(page, url, site):
+    """Reads every product matching the site's selectors on an already loaded page."""
     products_out = []
-    product_selector = site["product_selector"]
     name_selector = site["name_selector"]
     base_url = site.get("base_url", "")
+    products = page.locator(site["product_selector"])
+    count = await products.count()
+    for i in range(count):
+        try:
+            product_elem = products.nth(i)
+            name = normalize(await product_elem.locator(name_selector).text_content(timeout=15500))
+            if not site.get("skip_keywords", False) and not product_matches_keywords(name, site.get("name")):
+                continue
+            price = None
+            price_selector = site.get("price_selector")
+            if price_selector:
+                try:
+                    price = (await product_elem.locator(price_selector).text_content(timeout=15500)).strip()
+                except Exception:
+                    price = None
+            if not price:
+                price = "Okänt"
+            product_link_elem = product_elem.locator(site.get("product_link_selector"))
+            product_href = None
+            try:
+                product_href = await product_link_elem.get_attribute("href")
+            except Exception:
+                product_href = None
+            if product_href and not product_href.startswith("http"):
+                full_url = base_url.rstrip("/") + "/" + product_href.lstrip("/")
+            else:
+                full_url = product_href or url
+            product_link = clean_product_link(full_url)
+            availability_status = await get_availability_status(product_elem, site)
+            product_hash = generate_product_hash(name, site.get("name", ""))
+            preorder_selector = site.get("preorder_selector")
+            has_preorder_button = False
+            if preorder_selector:
+                try:
+                    preorder_elem = product_elem.locator(preorder_selector)
+                    has_preorder_button = (await preorder_elem.count()) > 0
+                except Exception:
+                    has_preorder_button = False
+            # Improved status priority: in-stock > preorder > other
+            if availability_status == "i lager":
+                status = "Tillbaka i lager"
+            elif has_preorder_button:
+                status = "Förbeställningsbar"
+            else:
+                status = availability_status
+
+            products_out.append({
+                "hash": product_hash,
+                "name": name,
+                "url": product_link or url,
+                "price": price,
+                "status": status,
+                "site_name": normalize(site.get("name", url))
+            })
+        except Exception as e:
+            print(f"Fel vid hantering av produkt {i} på {url}: {e}", flush=True)
+    return products_out
+
+FETCH_PAGE_JS = """
+async (url) => {
+    const started = performance.now();
+    try {
+        const response = await fetch(url, {credentials: "include"});
+        return {url, status: response.status, html: await response.text(), ms: performance.now() - started};
+    } catch (e) {
+        return {url, status: null, html: "", error: String(e), ms: performance.now() - started};
+    }
+}
+"""
+
+async def fetch_pages_in_page(page, urls, site, browser, controller=None):
+    """
+    Fetches further listing pages from inside an already loaded page, sharing its cookies and session,
+    and parses them with the same selectors. Returns (products, urls that need a real navigation).
+    Each fetch takes its own controller slot, so concurrency and pacing stay within the domain's limits.
+    """
+    products_out = []
+    fallback_urls = []
+    # Parsing happens in a separate page without JavaScript or network, so it stays cheap
+    parse_context = await browser.new_context(user_agent=USER_AGENT, java_script_enabled=False)
     try:
-        main_page = await browser.new_page(user_agent=USER_AGENT)
-        preorder_page = await browser.new_page(user_agent=USER_AGENT)
+        parse_page = await parse_context.new_page()
+        await parse_page.route("**/*", lambda route: route.abort())
+        parse_lock = asyncio.Lock()
+        async def fetch_and_parse(url):
+            if controller:
+                async with controller.slot():
+                    result = await page.evaluate(FETCH_PAGE_JS, url)
+            else:
+                result = await page.evaluate(FETCH_PAGE_JS, url)
+            html = result.get("html") or ""
+            # One parse page, so documents are parsed one at a time while other fetches run
+            async with parse_lock:
+                count = 0
+                if result.get("status") == 200 and html:
+                    await parse_page.set_content(html, wait_until="domcontentloaded")
+                    count = await parse_page.locator(site["product_selector"]).count()
+                if controller:
+                    controller.record(
+                        status=result.get("status"),
+                        latency=result.get("ms", 0) / 1000,
+                        kind="fetch",
+                        captcha=count == 0 and rate_controller.looks_like_captcha(html),
+                    )
+                if count == 0:
+                    # Not server-rendered (or blocked): let a full navigation handle this page
+                    print(f"[IN-PAGE] Inga produkter i hämtad sida, navigerar istället: {url}", flush=True)
+                    fallback_urls.append(url)
+                    return
+                products_out.extend(await extract_products(parse_page, url, site))
+        # One failure (e.g. the listing page navigated away) only sends that page back to navigation
+        results = await asyncio.gather(*(fetch_and_parse(url) for url in urls), return_exceptions=True)
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                print(f"[IN-PAGE] Kunde inte hämta {url}, navigerar istället: {result}", flush=True)
+                fallback_urls.append(url)
+    finally:
+        await parse_context.close()
+    return products_out, fallback_urls
+
+async def scrape_url(url, site, browser, controller=None, in_page_urls=None, fallback_urls=None):
+    """
+    Navigates to url and scrapes it. With in_page_urls, those pages are then fetched from inside
+    the loaded page; any that still need a real navigation are added to fallback_urls.
+    The controller's slot is held for the navigation only; each in-page fetch takes its own.
+    """
+    products_out = []
+    product_selector = site["product_selector"]
+    in_page_urls = list(in_page_urls or [])
+    context = None
+    holding_slot = False
+    try:
+        if controller:
+            await controller.acquire()
+            holding_slot = True
+        context = await browser_state.new_site_context(browser, url, USER_AGENT)
+        main_page = await context.new_page()
+        response = None
+        latency = None
         try:
-            await main_page.goto(url, timeout=30000, wait_until="networkidle")
-            await dismiss_cookies(main_page)
+            started = time.monotonic()
+            response = await main_page.goto(url, timeout=30000, wait_until="networkidle")
+            # Only the navigation itself: cookie banners, sleeps and scrolling say nothing about the server
+            latency = time.monotonic() - started
+            await dismiss_cookies(main_page, site)
             await main_page.wait_for_selector(product_selector, timeout=20000)
         except PlaywrightTimeoutError:
             print(f"[TIMEOUT] Page or products not loaded for: {url}")
             # Save HTML for debugging
             content = await main_page.content()
-            with open(f"debug_timeout_{site.get('name','no_name')}.html", "w", encoding="utf-8") as f:
-                f.write(content)
-            await main_page.close()
-            await preorder_page.close()
+            if controller:
+                controller.record(
+                    status=response.status if response else None,
+                    captcha=rate_controller.looks_like_captcha(content),
+                    timeout=True,
+                )
+            debug_artifacts.save("timeout", site.get("name", "no_name"), url, content)
             return []
         await scroll_to_load_all(main_page, product_selector, site.get("use_mouse_wheel", False))
         products = main_page.locator(product_selector)
         count = await products.count()
+        if controller and count > 0:
+            controller.record(status=response.status if response else None, latency=latency, kind="listing")
         if count == 0:
             content = await main_page.content()
-            with open(f"debug_zero_products_{site.get('name','no_name')}.html", "w", encoding="utf-8") as f:
-                f.write(content)
+            if controller:
+                controller.record(
+                    status=response.status if response else None,
+                    latency=latency,
+                    kind="listing",
+                    captcha=rate_controller.looks_like_captcha(content),
+                    empty=True,
+                )
+            debug_artifacts.save("zero_products", site.get("name", "no_name"), url, content)
             print(f"[WARNING] 0 products found for selector '{product_selector}' on {url}")
-        for i in range(count):
-            try:
-                product_elem = products.nth(i)
-                name = normalize(await product_elem.locator(name_selector).text_content(timeout=15500))
-                if not site.get("skip_keywords", False) and not product_matches_keywords(name):
-                    continue
-                price = None
-                price_selector = site.get("price_selector")
-                if price_selector:
-                    try:
-                        price = (await product_elem.locator(price_selector).text_content(timeout=15500)).strip()
-                    except Exception:
-                        price = None
-                if not price:
-                    price = "Okänt"
-                product_link_elem = product_elem.locator(site.get("product_link_selector"))
-                product_href = None
-                try:
-                    product_href = await product_link_elem.get_attribute("href")
-                except Exception:
-                    product_href = None
-                if product_href and not product_href.startswith("http"):
-                    full_url = base_url.rstrip("/") + "/" + product_href.lstrip("/")
-                else:
-                    full_url = product_href or url
-                product_link = clean_product_link(full_url)
-                availability_status = await get_availability_status(product_elem, site)
-                product_hash = generate_product_hash(name, site.get("name", ""))
-                preorder_selector = site.get("preorder_selector")
-                has_preorder_button = False
-                if preorder_selector:
-                    try:
-                        preorder_elem = product_elem.locator(preorder_selector)
-                        has_preorder_button = (await preorder_elem.count()) > 0
-                    except Exception:
-                        has_preorder_button = False
-                # Improved status priority: in-stock > preorder > other
-                if availability_status == "i lager":
-                    status = "Tillbaka i lager"
-                elif has_preorder_button:
-                    status = "Förbeställningsbar"
-                else:
-                    status = availability_status
-
-                products_out.append({
-                    "hash": product_hash,
-                    "name": name,
-                    "url": product_link or url,
-                    "price": price,
-                    "status": status,
-                    "site_name": normalize(site.get("name", url))
-                })
-            except Exception as e:
-                print(f"Fel vid hantering av produkt {i} på {url}: {e}", flush=True)
-        await preorder_page.close()
-        await main_page.close()
+        products_out = await extract_products(main_page, url, site)
+        if holding_slot:
+            holding_slot = False
+            await controller.release()
+        if in_page_urls:
+            extra_products, not_fetched = await fetch_pages_in_page(main_page, in_page_urls, site, browser, controller)
+            products_out.extend(extra_products)
+            in_page_urls = not_fetched
     except PlaywrightTimeoutError:
         print(f"[TIMEOUT] Playwright timed out for URL: {url}", flush=True)
     except Exception as e:
         print(f"Exception in scrape_url({url}): {e}", flush=True)
+    finally:
+        if holding_slot:
+            await controller.release()
+        if fallback_urls is not None:
+            fallback_urls.extend(in_page_urls)
+        if context is not None:
+            try:
+                await context.close()
+            except Exception:
+                pass
     return products_out
 
-async def scrape_site(site, browser):
+async def scrape_product_page(url, site, browser, controller=None):
+    """Scrapes a single product page, used for URLs found through the sitemap."""
+    context = None
+    try:
+        context = await browser_state.new_site_context(browser, url, USER_AGENT)
+        page = await context.new_page()
+        started = time.monotonic()
+        response = await page.goto(url, timeout=30000, wait_until="domcontentloaded")
+        if controller:
+            controller.record(
+                status=response.status if response else None,
+                latency=time.monotonic() - started,
+                kind="product",
+            )
+        await dismiss_cookies(page, site)
+        name_selector = site.get("product_page_name_selector", "h1")
+        name = None
+        if await page.locator(name_selector).count() > 0:
+            name = await page.locator(name_selector).first.text_content(timeout=10000)
+        if not name:
+            name = await page.get_attribute("meta[property='og:title']", "content", timeout=2000)
+        name = normalize(name)
+        if not name:
+            print(f"[SITEMAP] Hittade inget produktnamn på {url}", flush=True)
+            return None
+        if not site.get("skip_keywords", False) and not product_matches_keywords(name, site.get("name")):
+            return None
+        price = None
+        price_selector = site.get("product_page_price_selector")
+        try:
+            if price_selector:
+                price = (await page.locator(price_selector).first.text_content(timeout=5000)).strip()
+            else:
+                price = await page.get_attribute("meta[property='product:price:amount']", "content", timeout=2000)
+        except Exception:
+            price = None
+        status = "okänd"
+        if site.get("buy_button_selector"):
+            has_buy_button = await page.locator(site["buy_button_selector"]).count() > 0
+            status = "Tillbaka i lager" if has_buy_button else "slutsåld"
+        return {
+            "hash": generate_product_hash(name, site.get("name", "")),
+            "name": name,
+            "url": clean_product_link(url),
+            "price": price or "Okänt",
+            "status": status,
+            "site_name": normalize(site.get("name", url)),
+            "source": "sitemap"
+        }
+    except Exception as e:
+        print(f"[SITEMAP] Fel vid scrapning av produktsida {url}: {e}", flush=True)
+        return None
+    finally:
+        if context is not None:
+            try:
+                await context.close()
+            except Exception:
+                pass
+
+async def alert_discovered_products(sites, discovered, browser, seen_products, available_products,
+                                    unfiltered_sites, early_alerted_urls):
+    """Scrapes product pages for new/changed sitemap URLs and notifies right away, ahead of the crawl."""
+    sites_by_key = {run_planner.site_key(site): site for site in sites}
+    for key, urls in discovered.items():
+        if not urls:
+            continue
+        site = sites_by_key[key]
+        async def limited_product_scrape(url):
+            controller = rate_controller.get_controller(url, site.get("max_parallel_urls"))
+            async with controller.slot():
+                return await scrape_product_page(url, site, browser, controller)
+        products = [prod for prod in await asyncio.gather(*(limited_product_scrape(url) for url in urls)) if prod]
+        # Work out the notifications on a copy: the real state only changes once they have gone out,
+        # so a deadline cancelling the dispatch leaves them for the crawl to send
+        preview_seen = copy.deepcopy(seen_products)
+        preview_available = dict(available_products)
+        notifications = []
+        for prod in products:
+            notif = detect_change(prod, preview_seen, preview_available, unfiltered_sites)
+            if notif:
+                notifications.append(notif)
+        if notifications and SUBSCRIPTION_INDEX.subscriptions:
+            sent = await subscriptions.dispatch(
+                notifications, SUBSCRIPTION_INDEX, build_discord_payload, post_discord_payload
+            )
+            print(f"[SITEMAP] {site.get('name')}: skickade {sent} meddelanden direkt.", flush=True)
+        for prod in products:
+            if detect_change(prod, seen_products, available_products, unfiltered_sites):
+                early_alerted_urls.add(product_state.canonical_url(prod["url"]))
+
+def prepare_watchlist(entries, sites):
+    """Fills in site, buy_button_selector and keyword behaviour from the matching site config."""
+    sites_by_domain = {}
+    for site in sites:
+        urls = [site.get("base_url"), site.get("api_base_url")]
+        if site.get("type", "browser").lower() != "api":
+            urls += get_urls_to_scrape(site)[:1]
+        for url in urls:
+            if url:
+                sites_by_domain.setdefault(browser_state.domain_of(url), site)
+    prepared = []
+    for entry in entries:
+        if not entry.get("url"):
+            continue
+        entry = dict(entry)
+        site = sites_by_domain.get(browser_state.domain_of(entry["url"]), {})
+        entry.setdefault("site", site.get("name") or browser_state.domain_of(entry["url"]))
+        if site.get("buy_button_selector"):
+            entry.setdefault("buy_button_selector", site["buy_button_selector"])
+        prepared.append(entry)
+    return prepared
+
+def make_watch_handler(seen_products, available_products, alerted_urls=None):
+    """
+    Status changes from the watchlist go through the same state and notification path as the crawl.
+    URLs announced here are added to alerted_urls so the crawl doesn't announce them again.
+    """
+    async def on_change(entry, status, price, name):
+        url = clean_product_link(entry["url"])
+        # Use the crawl's identity for the product, found through its URL
+        prod_hash, known = product_state.find_by_url(seen_products, url)
+        if known is not None:
+            name, site_name = known["name"], known.get("site") or normalize(entry["site"])
+        else:
+            name, site_name = normalize(entry.get("name") or name), normalize(entry["site"])
+            if not name:
+                print(f"[WATCH] {entry['url']} är inte känd från genomsökningen – ange 'name' i watchlistan.", flush=True)
+                return
+            prod_hash = generate_product_hash(name, site_name)
+        prod = {
+            "hash": prod_hash,
+            "name": name,
+            "url": url,
+            "price": price or "Okänt",
+            "status": status,
+            "site_name": site_name
+        }
+        if status not in ("Tillbaka i lager", "Förbeställningsbar"):
+            # Gone again: forget it so the next restock is announced
+            available_products.pop(prod["hash"], None)
+        notif = detect_change(prod, seen_products, available_products, set())
+        if notif:
+            # Watched products were picked by hand, so keyword filters don't apply
+            notif["skip_keywords"] = True
+            if alerted_urls is not None:
+                alerted_urls.add(product_state.canonical_url(url))
+            if SUBSCRIPTION_INDEX.subscriptions:
+                await subscriptions.dispatch([notif], SUBSCRIPTION_INDEX, build_discord_payload, post_discord_payload)
+            save_json(SEEN_PRODUCTS_FILE, seen_products)
+            save_json(AVAILABLE_PRODUCTS_FILE, available_products)
+    return on_change
+
+async def scrape_site(site, browser, discovered=None):
     if site.get("type", "browser").lower() == "api":
-        return get_api_products(site)
+        # requests is blocking, keep it off the event loop so deadlines still fire
+        return await asyncio.to_thread(get_api_products, site), "ok"
+    changed = (discovered or {}).get(run_planner.site_key(site))
+    if sitemap_discovery.can_skip_crawl(site, changed):
+        print(f"[SITEMAP] {site.get('name')}: inga ändringar i sitemap – återanvänder senaste genomsökningen.", flush=True)
+        return sitemap_discovery.cached_products(site), "cached"
     urls = get_urls_to_scrape(site)
-    semaphore = asyncio.Semaphore(site.get("max_parallel_urls", PARALLEL_URLS_PER_SITE))
-    async def sem_scrape(url):
-        async with semaphore:
-            return await scrape_url(url, site, browser)
-    url_tasks = [asyncio.create_task(asyncio.wait_for(sem_scrape(url), timeout=SITE_TIMEOUT)) for url in urls]
+    async def limited_scrape(url, in_page_urls=None, fallback_urls=None):
+        # Concurrency and pacing are learned per domain; max_parallel_urls caps it for a site
+        controller = rate_controller.get_controller(url, site.get("max_parallel_urls"))
+        return await scrape_url(url, site, browser, controller, in_page_urls, fallback_urls)
     products = []
+    if site.get("in_page_pagination") is True and len(urls) > 1:
+        # One real navigation; the other pages are fetched from inside it
+        fallback_urls = []
+        try:
+            products.extend(await asyncio.wait_for(
+                limited_scrape(urls[0], urls[1:], fallback_urls), timeout=SITE_TIMEOUT
+            ))
+            urls = fallback_urls
+        except asyncio.TimeoutError:
+            print("[TIMEOUT] In-page pagination timed out, navigating to each page instead.", flush=True)
+            urls = urls[1:]
+    url_tasks = [asyncio.create_task(asyncio.wait_for(limited_scrape(url), timeout=SITE_TIMEOUT)) for url in urls]
     for task in asyncio.as_completed(url_tasks):
         try:
             result = await task
             products.extend(result)
         except asyncio.TimeoutError:
             print("[TIMEOUT] A single URL scrape timed out.", flush=True)
-    return products
+    if sitemap_discovery.sitemap_urls(site):
+        sitemap_discovery.remember_crawl(site, products)
+    return products, "ok"
+
+async def run_planned_site(site, slice_, browser, semaphore, deadline, discovered=None, started_at=None):
+    async with semaphore:
+        # The slice was planned up front; time spent waiting for a free slot is taken from it
+        slice_ = min(slice_, deadline - time.time())
+        if slice_ <= 0:
+            print(f"[PLANNER] Hoppar över {site.get('name')} – ingen tid kvar.", flush=True)
+            return site, [], 0.0, "skipped", 0.0
+        started = time.time()
+        if started_at is not None:
+            # Lets main() record sites that the global deadline cancels mid-run
+            started_at[run_planner.site_key(site)] = (started, slice_)
+        try:
+            products, outcome = await asyncio.wait_for(scrape_site(site, browser, discovered), timeout=slice_)
+            return site, products, time.time() - started, outcome, slice_
+        except asyncio.TimeoutError:
+            print(f"[TIMEOUT] {site.get('name')} överskred sitt tidsfönster på {slice_:.0f} s.", flush=True)
+            return site, [], time.time() - started, "timeout", slice_
 
 async def main():
+    run_start = time.time()
     sites = google_sheets.read_sites_from_sheet()  # Uses GOOGLE_SHEETS_ID_S for config
-    seen_products = load_json(SEEN_PRODUCTS_FILE)
+    BROWSER_SITE_NAMES.update(
+        site.get("name", "") for site in sites or [] if site.get("type", "browser").lower() != "api"
+    )
+    seen_products = product_state.migrate_seen(load_json(SEEN_PRODUCTS_FILE))
     available_products = load_json(AVAILABLE_PRODUCTS_FILE)
     if not sites:
         print("Inga sites hittades i Google Sheets eller arket är tomt.", flush=True)
         return
-    all_site_products = []
+    # Scraping must stop early enough to leave room for notifications and saving state
+    scrape_deadline = run_start + GLOBAL_SCRIPT_TIMEOUT - run_planner.POST_SCRAPE_RESERVE
+    site_stats = run_planner.load_site_stats()
+    plan = run_planner.plan_sites(sites, site_stats, scrape_deadline, max_site_timeout=SITE_TIMEOUT*2)
+    print("[PLANNER] Körordning: " + ", ".join(
+        f"{site.get('name')} ({slice_:.0f} s)" for site, slice_ in plan
+    ), flush=True)
+    # API sites and skip_keywords sites are not keyword filtered when scraped
+    unfiltered_sites = {
+        run_planner.site_key(site) for site in sites
+        if site.get("skip_keywords") is True or site.get("type", "browser").lower() == "api"
+    }
+    # Sitemaps are cheap to diff, so do it for every site before the crawl starts
+    sitemap_sites = [site for site in sites if sitemap_discovery.sitemap_urls(site)]
+    discovered = {}
+    if sitemap_sites:
+        changes = await asyncio.gather(*(sitemap_discovery.discover_changes(site) for site in sitemap_sites))
+        discovered = {run_planner.site_key(site): c for site, c in zip(sitemap_sites, changes) if c is not None}
+    early_alerted_urls = set()
+    site_runs = []
     # Use Stealth's context manager instead of async_playwright directly!
     async with Stealth().use_async(async_playwright()) as p:
         browser = await p.chromium.launch(headless=True, args=["--disable-blink-features=AutomationControlled"])
         # REMOVE: any call to stealth_async or stealth.apply or similar!
+        # The watchlist polls its products on its own connections and pages for as long as the crawl runs
+        watch_stop = asyncio.Event()
+        watch_task = asyncio.create_task(watchlist.run_watchlist(
+            prepare_watchlist(watchlist.load_watchlist(), sites),
+            make_watch_handler(seen_products, available_products, early_alerted_urls),
+            watch_stop,
+            browser,
+        ))
+        discovery_task = asyncio.create_task(alert_discovered_products(
+            sites, discovered, browser, seen_products, available_products, unfiltered_sites, early_alerted_urls
+        ))
+        site_semaphore = asyncio.Semaphore(PARALLEL_SITES)
+        site_started = {}
         site_tasks = [
-            asyncio.create_task(asyncio.wait_for(scrape_site(site, browser), timeout=SITE_TIMEOUT*2))
-            for site in sites
+            asyncio.create_task(run_planned_site(
+                site, slice_, browser, site_semaphore, scrape_deadline, discovered, site_started
+            ))
+            for site, slice_ in plan
         ]
+        done, pending = await asyncio.wait(site_tasks, timeout=max(0.0, scrape_deadline - time.time()))
+        cancelled_at = time.time()
+        for task in pending:
+            task.cancel()
+        if pending:
+            print(f"[PLANNER] Deadline nådd – avbryter {len(pending)} sites.", flush=True)
+            await asyncio.gather(*pending, return_exceptions=True)
+        for task, (site, _) in zip(site_tasks, plan):
+            if task in done and not task.cancelled() and task.exception() is None:
+                site_runs.append(task.result())
+            elif task in done and not task.cancelled():
+                print(f"Exception during global site scraping: {task.exception()}", flush=True)
+            elif run_planner.site_key(site) in site_started:
+                # Still running at the deadline: the planner has to learn that it overran
+                started, slice_ = site_started[run_planner.site_key(site)]
+                site_runs.append((site, [], cancelled_at - started, "timeout", slice_))
         try:
-            for task in asyncio.as_completed(site_tasks):
-                try:
-                    result = await task
-                    all_site_products.append(result)
-                except asyncio.TimeoutError:
-                    print("[TIMEOUT] A site scrape timed out.", flush=True)
+            await asyncio.wait_for(discovery_task, timeout=max(1.0, scrape_deadline - time.time()))
         except Exception as e:
-            print(f"Exception during global site scraping: {e}", flush=True)
+            print(f"[SITEMAP] Direktnotiser avbröts: {e!r}", flush=True)
+        watch_stop.set()
+        await asyncio.gather(watch_task, return_exceptions=True)
         await browser.close()
+    # A cached run reuses the site's last complete crawl, so its products count as current
+    all_site_products = [products for _, products, _, outcome, _ in site_runs if outcome in ("ok", "cached")]
+    all_sites_completed = len(all_site_products) == len(sites)
     found_products = {}
     for site_products in all_site_products:
         for prod in site_products:
             found_products[prod["hash"]] = prod  # last one wins
+    # Cross-store grouping is updated incrementally with this run's offers
+    product_matcher = product_matching.ProductMatcher.load()
+    for prod in found_products.values():
+        product_matcher.assign(prod)
     notifications_to_send = []
     products_to_update_google = []
     for prod_hash, prod in found_products.items():
-        if prod_hash not in seen_products:
-            notifications_to_send.append({
-                "name": prod["name"],
-                "url": prod["url"],
-                "price": prod["price"],
-                "status": "Ny produkt",
-                "site_name": prod["site_name"]
-            })
-            seen_products[prod_hash] = prod["name"]
-        elif prod["status"] in ("i lager", "förbeställningsbar", "Tillbaka i lager", "Förbeställningsbar") and prod_hash not in available_products:
-            notifications_to_send.append({
-                "name": prod["name"],
-                "url": prod["url"],
-                "price": prod["price"],
-                "status": "Tillbaka i lager" if prod["status"] == "i lager" else "Förbeställningsbar",
-                "site_name": prod["site_name"]
-            })
-            available_products[prod_hash] = prod["name"]
-        if GOOGLE_SHEETS_CREDS and GOOGLE_SHEETS_ID and prod["status"].lower() in [
+        notif = detect_change(prod, seen_products, available_products, unfiltered_sites)
+        # Already announced by sitemap discovery or the watchlist, possibly under a slightly different name
+        if notif and product_state.canonical_url(prod["url"]) not in early_alerted_urls:
+            notifications_to_send.append(notif)
+        # Sheets lists what the global filter covers, not products kept only for a subscriber
+        in_sheet_scope = run_planner.site_key({"name": prod["site_name"]}) in unfiltered_sites or \
+            matches_global_keywords(prod["name"])
+        if GOOGLE_SHEETS_CREDS and GOOGLE_SHEETS_ID and in_sheet_scope and prod["status"].lower() in [
             "i lager", "tillbaka i lager", "förbeställningsbar"
         ]:
             products_to_update_google.append({
@@ -442,21 +887,59 @@ async def main():
                 'status': prod["status"]
             })
     hashes_now = set(found_products.keys())
+    completed_sites = {
+        run_planner.site_key(site) for site, _, _, outcome, _ in site_runs if outcome in ("ok", "cached")
+    }
     for old_hash in list(available_products.keys()):
-        if old_hash not in hashes_now:
+        if old_hash in hashes_now:
+            continue
+        # Only a site that finished its crawl can tell us a product is gone
+        site_name = seen_products.get(old_hash, {}).get("site")
+        if (site_name and run_planner.site_key({"name": site_name}) in completed_sites) or \
+                (not site_name and all_sites_completed):
             print(f"Produkten med hash {old_hash} hittades inte längre på någon site — tas bort.", flush=True)
             del available_products[old_hash]
+    if not all_sites_completed:
+        print("[PLANNER] Alla sites blev inte klara – behåller deras produkter.", flush=True)
+    product_state.compact(seen_products, available_products)
+    product_matcher.compact()
+    alerts_per_site = {}
     for notif in notifications_to_send:
-        await send_discord_message(
-            notif["name"], notif["url"], notif["price"], notif["status"], notif["site_name"]
+        key = run_planner.site_key({"name": notif["site_name"]})
+        alerts_per_site[key] = alerts_per_site.get(key, 0) + 1
+    for site, products, duration, outcome, slice_ in site_runs:
+        run_planner.record_site_run(
+            site_stats, site, duration, outcome,
+            product_count=len(products),
+            alert_count=alerts_per_site.get(run_planner.site_key(site), 0),
+            slice_=slice_,
         )
-        await asyncio.sleep(1.5)
+    run_planner.save_site_stats(site_stats)
+    browser_state.save_banner_knowledge()
+    rate_controller.save_rate_limits()
+    sitemap_discovery.save_state()
+    product_matcher.save()
+    # Saved before dispatching, so a slow Discord/Sheets phase hitting the global timeout can't lose it
     save_json(SEEN_PRODUCTS_FILE, seen_products)
     save_json(AVAILABLE_PRODUCTS_FILE, available_products)
+    await debug_artifacts.flush()
+    # Sheets runs on its own thread while Discord messages go out, so the two overlap
+    sheets_task = None
     if GOOGLE_SHEETS_CREDS and GOOGLE_SHEETS_ID and products_to_update_google:
-        google_sheets.deduplicate_sheet_hashes()
-        google_sheets.update_or_append_rows(products_to_update_google)
-        google_sheets.delete_rows_with_missing_hashes(available_products)
+        sheets_task = asyncio.create_task(
+            google_sheets.sync_products_async(products_to_update_google, available_products)
+        )
+    # One message per product and status, listing every store's price
+    notifications_to_send = product_matching.group_notifications(notifications_to_send, product_matcher)
+    if SUBSCRIPTION_INDEX.subscriptions:
+        sent = await subscriptions.dispatch(
+            notifications_to_send, SUBSCRIPTION_INDEX, build_discord_payload, post_discord_payload
+        )
+        print(f"[DISCORD] Skickade {sent} meddelanden till {len(SUBSCRIPTION_INDEX.subscriptions)} prenumerationer.", flush=True)
+    elif notifications_to_send:
+        print("No Discord webhook set in environment variable.", flush=True)
+    if sheets_task:
+        await sheets_task
     print("\n--- Alla produkter på första siten ---", flush=True)
     if all_site_products and len(all_site_products[0]) > 0:
         for prod in all_site_products[0]:
@@ -464,7 +947,32 @@ async def main():
     if not notifications_to_send:
         print("Inga nya eller återkommande produkter upptäcktes.", flush=True)
 
+async def watch_only(duration):
+    """Runs only the watchlist, without the bulk crawl."""
+    sites = google_sheets.read_sites_from_sheet()
+    BROWSER_SITE_NAMES.update(
+        site.get("name", "") for site in sites or [] if site.get("type", "browser").lower() != "api"
+    )
+    entries = prepare_watchlist(watchlist.load_watchlist(), sites or [])
+    if not entries:
+        print("Watchlistan är tom.", flush=True)
+        return
+    seen_products = product_state.migrate_seen(load_json(SEEN_PRODUCTS_FILE))
+    available_products = load_json(AVAILABLE_PRODUCTS_FILE)
+    stop = asyncio.Event()
+    asyncio.get_running_loop().call_later(duration, stop.set)
+    async with Stealth().use_async(async_playwright()) as p:
+        browser = await p.chromium.launch(headless=True, args=["--disable-blink-features=AutomationControlled"])
+        await watchlist.run_watchlist(entries, make_watch_handler(seen_products, available_products), stop, browser)
+        await browser.close()
+    save_json(SEEN_PRODUCTS_FILE, seen_products)
+    save_json(AVAILABLE_PRODUCTS_FILE, available_products)
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--watchlist":
+        duration = safe_int(sys.argv[2], WATCHLIST_ONLY_DURATION) if len(sys.argv) > 2 else WATCHLIST_ONLY_DURATION
+        asyncio.run(watch_only(duration))
+        sys.exit(0)
     try:
         asyncio.run(asyncio.wait_for(main(), timeout=GLOBAL_SCRIPT_TIMEOUT))
     except asyncio.TimeoutError:
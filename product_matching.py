@@ -0,0 +1,259 @@
+import json
+import os
+import re
+import time
+import unicodedata
+
+from product_state import SEEN_RETENTION_DAYS, today
+from subscriptions import parse_price
+
+DATA_DIR = "data"
+PRODUCT_GROUPS_FILE = os.path.join(DATA_DIR, "product_groups.json")
+
+SIMILARITY_THRESHOLD = 0.5         # överlapp av resttoken inom samma set + produkttyp
+LOOSE_SIMILARITY_THRESHOLD = 0.8   # Jaccard när set eller typ inte kunde tolkas
+RARE_TOKEN_LIMIT = 50              # token i fler grupper än så används inte för att hitta kandidater
+
+STOPWORDS = {
+    "pokemon", "tcg", "trading", "card", "cards", "game", "kortspel", "the", "of", "and", "och",
+    "en", "ett", "st", "sv", "ex",
+}
+# Ord som skiljer varianter av samma produkt åt och därför måste stämma exakt
+VARIANT_TOKENS = {
+    "center", "pc", "japansk", "japanese", "jp", "korean", "koreansk", "chinese", "kinesisk",
+    "sleeved", "half", "mini", "case", "english", "engelsk", "tysk", "german",
+}
+SET_NAMES = [
+    "destined rivals", "prismatic evolutions", "journey together", "black bolt", "white flare",
+    "surging sparks", "stellar crown", "shrouded fable", "twilight masquerade", "temporal forces",
+    "paldean fates", "paradox rift", "obsidian flames", "paldea evolved", "crown zenith",
+    "silver tempest", "lost origin", "astral radiance", "brilliant stars", "fusion strike",
+    "evolving skies", "celebrations", "mega evolution", "phantasmal flames", "151",
+]
+# Längre uttryck först så att "booster display" inte tolkas som "booster"
+PRODUCT_TYPES = [
+    (r"elite trainer box|\betb\b", "etb"),
+    (r"booster display|booster box|display box|\bdisplay\b", "display"),
+    (r"booster bundle|\bbundle\b", "bundle"),
+    (r"build (?:&|and|och) battle", "build_battle"),
+    (r"super premium collection", "super_premium_collection"),
+    (r"premium collection", "premium_collection"),
+    (r"\bcollection\b|\bkollektion\b", "collection"),
+    (r"league battle deck|battle deck|\btheme deck\b", "battle_deck"),
+    (r"\bblister\b", "blister"),
+    (r"\btin\b", "tin"),
+    (r"booster pack|\bbooster\b", "booster"),
+]
+PACK_COUNT_RE = re.compile(r"\b(\d{1,3})\s*(?:-\s*)?(?:pack|p\b|st\b|x\b|boosters?\b|booster packs?)")
+
+
+def _fold(text):
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def analyse_name(name):
+    """
+    Tolkar ett produktnamn: (set, produkttyp, antal paket, varianttoken, token, resttoken).
+    Resttoken är det som blir kvar när set, typ och antal plockats bort, t.ex. "arctibax".
+    """
+    folded = _fold(name).replace("&", " and ")
+    rest = folded
+    product_set = next((s for s in SET_NAMES if re.search(rf"\b{re.escape(s)}\b", folded)), None)
+    if product_set:
+        rest = re.sub(rf"\b{re.escape(product_set)}\b", " ", rest)
+    product_type = None
+    for pattern, type_name in PRODUCT_TYPES:
+        if re.search(pattern, folded):
+            product_type = type_name
+            rest = re.sub(pattern, " ", rest)
+            break
+    count_match = PACK_COUNT_RE.search(folded)
+    pack_count = int(count_match.group(1)) if count_match else None
+    rest = PACK_COUNT_RE.sub(" ", rest)
+    tokens = set(re.findall(r"[a-z0-9]+", folded)) - STOPWORDS
+    rest_tokens = set(re.findall(r"[a-z0-9]+", rest)) - STOPWORDS - VARIANT_TOKENS
+    variants = frozenset(tokens & VARIANT_TOKENS)
+    return product_set, product_type, pack_count, variants, tokens, rest_tokens
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _containment(a, b):
+    # Butiker lägger ofta till eller utelämnar ord ("Scarlet & Violet 4:"), så jämför mot den kortare
+    if not a or not b:
+        return 1.0
+    return len(a & b) / min(len(a), len(b))
+
+
+class ProductMatcher:
+    """
+    Grupperar samma produkt från olika butiker. Grupperna sparas mellan körningar och uppdateras
+    inkrementellt: en ny produkt jämförs bara mot grupper i samma block (set + typ) eller,
+    om namnet inte kunde tolkas, mot grupper som delar ett ovanligt token.
+    """
+
+    def __init__(self, groups=None):
+        self.groups = groups or {}
+        self._by_product = {}
+        self._by_block = {}
+        self._by_token = {}
+        self._token_sets = {}
+        self._seen_this_run = set()
+        self._next_id = 1
+        for group_id, group in self.groups.items():
+            self._index_group(group_id, group)
+            self._next_id = max(self._next_id, int(group_id) + 1)
+
+    @classmethod
+    def load(cls):
+        if os.path.exists(PRODUCT_GROUPS_FILE):
+            with open(PRODUCT_GROUPS_FILE, "r", encoding="utf-8") as f:
+                return cls(json.load(f))
+        return cls()
+
+    def save(self):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(PRODUCT_GROUPS_FILE, "w", encoding="utf-8") as f:
+            json.dump(self.groups, f, ensure_ascii=False, indent=2)
+
+    def _index_group(self, group_id, group):
+        self._token_sets[group_id] = (frozenset(group["tokens"]), frozenset(group.get("rest_tokens", [])))
+        for prod_hash in group["members"]:
+            self._by_product[prod_hash] = group_id
+        if group.get("set") and group.get("type"):
+            self._by_block.setdefault((group["set"], group["type"]), set()).add(group_id)
+        for token in group["tokens"]:
+            self._by_token.setdefault(token, set()).add(group_id)
+
+    def _candidates(self, product_set, product_type, tokens):
+        if product_set and product_type:
+            return self._by_block.get((product_set, product_type), set())
+        candidates = set()
+        for token in tokens:
+            groups = self._by_token.get(token, set())
+            if len(groups) <= RARE_TOKEN_LIMIT:
+                candidates |= groups
+        return candidates
+
+    def _score(self, group_id, product_set, product_type, tokens, rest_tokens):
+        group_tokens, group_rest_tokens = self._token_sets[group_id]
+        if product_set and product_type:
+            return _containment(group_rest_tokens, rest_tokens)
+        return _jaccard(group_tokens, tokens)
+
+    def _compatible(self, group, site, product_set, product_type, pack_count, variants):
+        if any(member["site"] == site for member in group["members"].values()):
+            return False  # samma butik: olika produkter, inte olika erbjudanden
+        if frozenset(group.get("variants", [])) != variants:
+            return False
+        if group.get("set") != product_set or group.get("type") != product_type:
+            return False
+        if group.get("pack_count") and pack_count and group["pack_count"] != pack_count:
+            return False
+        return True
+
+    def assign(self, prod):
+        """Lägger till eller uppdaterar produktens erbjudande och returnerar dess grupp-id."""
+        offer = {
+            "site": prod["site_name"],
+            "name": prod["name"],
+            "price": prod["price"],
+            "url": prod["url"],
+            "status": prod["status"],
+            "last_seen": today(),
+        }
+        self._seen_this_run.add(prod["hash"])
+        group_id = self._by_product.get(prod["hash"])
+        if group_id is not None:
+            self.groups[group_id]["members"][prod["hash"]] = offer
+            return group_id
+        product_set, product_type, pack_count, variants, tokens, rest_tokens = analyse_name(prod["name"])
+        threshold = SIMILARITY_THRESHOLD if product_set and product_type else LOOSE_SIMILARITY_THRESHOLD
+        best, best_score = None, 0.0
+        for candidate_id in self._candidates(product_set, product_type, tokens):
+            group = self.groups[candidate_id]
+            if not self._compatible(group, prod["site_name"], product_set, product_type, pack_count, variants):
+                continue
+            score = self._score(candidate_id, product_set, product_type, tokens, rest_tokens)
+            if score >= threshold and score > best_score:
+                best, best_score = candidate_id, score
+        if best is None:
+            best = str(self._next_id)
+            self._next_id += 1
+            self.groups[best] = {
+                "set": product_set,
+                "type": product_type,
+                "pack_count": pack_count,
+                "variants": sorted(variants),
+                "tokens": sorted(tokens),
+                "rest_tokens": sorted(rest_tokens),
+                "members": {},
+            }
+            self._index_group(best, self.groups[best])
+        group = self.groups[best]
+        group["members"][prod["hash"]] = offer
+        self._by_product[prod["hash"]] = best
+        if not group.get("pack_count") and pack_count:
+            group["pack_count"] = pack_count
+        return best
+
+    def group_of(self, prod_hash):
+        return self._by_product.get(prod_hash)
+
+    def offers(self, group_id):
+        """
+        Gruppens aktuella erbjudanden, billigast först (okänt pris sist). Bara butiker vars produkt
+        hittats i den här körningen tas med; äldre medlemmars status och pris kan vara inaktuella.
+        """
+        members = self.groups.get(group_id, {}).get("members", {})
+        current = [m for prod_hash, m in members.items() if prod_hash in self._seen_this_run]
+        return sorted(current, key=lambda m: (parse_price(m["price"]) is None, parse_price(m["price"]) or 0))
+
+    def compact(self, retention_days=SEEN_RETENTION_DAYS):
+        cutoff = time.strftime("%Y-%m-%d", time.gmtime(time.time() - retention_days * 86400))
+        for group_id in list(self.groups):
+            members = self.groups[group_id]["members"]
+            for prod_hash in [h for h, m in members.items() if m.get("last_seen", "") < cutoff]:
+                del members[prod_hash]
+                self._by_product.pop(prod_hash, None)
+            if not members:
+                group = self.groups.pop(group_id)
+                self._token_sets.pop(group_id, None)
+                self._by_block.get((group.get("set"), group.get("type")), set()).discard(group_id)
+                for token in group["tokens"]:
+                    self._by_token.get(token, set()).discard(group_id)
+
+
+def group_notifications(notifications, matcher):
+    """
+    Slår ihop notiser för samma produkt i olika butiker till en notis per produkt och status,
+    med alla butikers aktuella priser i 'offers' och den billigaste butikens länk.
+    'changed_sites' anger butikerna vars produkt faktiskt ändrats och används för prenumerationers site-filter.
+    """
+    grouped = {}
+    for notif in notifications:
+        group_id = matcher.group_of(notif.get("hash"))
+        key = (group_id, notif["status"]) if group_id is not None else (id(notif), notif["status"])
+        grouped.setdefault(key, []).append(notif)
+    result = []
+    for (group_id, _), notifs in grouped.items():
+        offers = matcher.offers(group_id) if isinstance(group_id, str) else []
+        if len(offers) < 2:
+            result.extend(notifs)
+            continue
+        changed_sites = {n["site_name"] for n in notifs}
+        cheapest = next((o for o in offers if o["site"] in changed_sites), offers[0])
+        merged = dict(next(n for n in notifs if n["site_name"] == cheapest["site"]))
+        merged["offers"] = [
+            {"site_name": o["site"], "price": o["price"], "url": o["url"], "status": o["status"]}
+            for o in offers
+        ]
+        merged["changed_sites"] = sorted(changed_sites)
+        merged["skip_keywords"] = any(n.get("skip_keywords") for n in notifs)
+        result.append(merged)
+    return result
@@ -0,0 +1,157 @@
+import re
+import time
+from urllib.parse import urlparse
+
+SEEN_RETENTION_DAYS = 90  # produkter som inte setts på så här länge tas bort ur seen_products
+UNKNOWN_STATES = {"", "okänd"}  # scrapern kunde inte avgöra statusen: behåll den förra
+
+# Shopify-länkar från en kollektion pekar på samma produkt som /products/<handle>
+_SHOPIFY_COLLECTION_RE = re.compile(r"/collections/[^/]+(/products/[^/]+)")
+
+# Legacy-poster (gamla formatet hash -> namn) per exakt namn, för att kunna ta över dem under nya nycklar
+_legacy_by_name = {}
+
+
+def today():
+    # Datum, inte tidsstämpel: filen ändras då högst en gång per dag för en oförändrad produkt
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+def fingerprint(prod):
+    """
+    Produktens tillstånd (normaliserad status), skilt från dess identitet.
+    Priset ingår inte: en prisändring ska varken ge en notis eller skriva om seen_products.
+    """
+    status = (prod.get("status") or "").lower()
+    return "tillbaka i lager" if status == "i lager" else status
+
+
+def new_entry(prod):
+    entry = {
+        "name": prod["name"],
+        "site": prod.get("site_name", ""),
+        "url": prod.get("url", ""),
+        "state": fingerprint(prod) if fingerprint(prod) not in UNKNOWN_STATES else None,
+        "last_seen": today(),
+    }
+    if prod.get("source") == "sitemap":
+        # Namnet kommer från produktsidan; genomsökningen tar över posten när den hittar produkten
+        entry["source"] = "sitemap"
+    return entry
+
+
+def canonical_url(url):
+    """Jämförbar form av en produkt-URL: utan www, query och avslutande snedstreck."""
+    parsed = urlparse((url or "").strip())
+    host = parsed.netloc.lower()
+    host = host[4:] if host.startswith("www.") else host
+    path = _SHOPIFY_COLLECTION_RE.sub(r"\1", parsed.path).rstrip("/").lower()
+    return f"{host}{path}"
+
+
+def migrate_seen(seen_products):
+    """
+    Konverterar seen_products från {hash: namn} till {hash: {name, site, url, state, last_seen}}.
+    Gamla poster markeras som legacy; de tas över av första produkten med samma exakta namn
+    från en API-site (där gamla nycklar innehöll lagersaldo) eller försvinner efter SEEN_RETENTION_DAYS.
+    """
+    _legacy_by_name.clear()
+    for prod_hash, value in list(seen_products.items()):
+        if isinstance(value, str):
+            value = {"name": value, "site": "", "state": None, "last_seen": today(), "legacy": True}
+            seen_products[prod_hash] = value
+        if value.get("legacy"):
+            _legacy_by_name.setdefault(value["name"], []).append(prod_hash)
+    return seen_products
+
+
+def touch(entry, prod):
+    """
+    Markerar en känd produkt som sedd nu. Returnerar True om dess tillstånd ändrats sedan förra gången;
+    en post utan känt tidigare tillstånd räknas inte som ändrad.
+    """
+    entry.pop("legacy", None)
+    entry["name"] = prod["name"]
+    entry["site"] = prod.get("site_name", entry.get("site", ""))
+    if prod.get("url"):
+        entry["url"] = prod["url"]
+    entry["last_seen"] = today()
+    state = fingerprint(prod)
+    if state in UNKNOWN_STATES:
+        return False
+    previous = entry.get("state")
+    entry["state"] = state
+    return previous is not None and previous != state
+
+
+def find_by_url(seen_products, url, site=None):
+    """Returnerar (hash, post) för produkten med samma kanoniska URL (och site), eller (None, None)."""
+    key = canonical_url(url)
+    if not key:
+        return None, None
+    for prod_hash, entry in seen_products.items():
+        if entry.get("url") and canonical_url(entry["url"]) == key and (site is None or entry.get("site") == site):
+            return prod_hash, entry
+    return None, None
+
+
+def adopt_by_url(seen_products, available_products, prod):
+    """
+    Hittar samma produkt under en annan nyckel via URL:en: listningens namn och produktsidans h1 skiljer sig ofta.
+    En produktsida från sitemapen (source 'sitemap') använder den befintliga nyckeln; genomsökningen flyttar
+    en post som sitemapen skapat till sin egen nyckel, som är produktens identitet. Returnerar posten, eller None.
+    """
+    old_hash, entry = find_by_url(seen_products, prod.get("url"), prod.get("site_name"))
+    if entry is None:
+        return None
+    if prod.get("source") == "sitemap":
+        prod["hash"] = old_hash
+        return entry
+    if entry.get("source") != "sitemap":
+        return None  # en annan listad produkt med samma länk, t.ex. en variant
+    entry.pop("source")
+    del seen_products[old_hash]
+    seen_products[prod["hash"]] = entry
+    if available_products.pop(old_hash, None) is not None:
+        available_products[prod["hash"]] = prod["name"]
+    return entry
+
+
+def adopt_legacy(seen_products, available_products, prod, reserved_hashes=()):
+    """
+    Flyttar legacy-poster med produktens namn till dess stabila nyckel och slår ihop dubbletterna.
+    Legacy-poster saknar site, så reserved_hashes anger nycklar som andra sites fortfarande använder
+    för samma namn; de tas inte över. Returnerar den nya posten, eller None om det inte fanns någon.
+    """
+    if prod.get("source") != "api":
+        return None
+    # Inte pop: en förhandsgranskning på en kopia av seen_products får inte förbruka posterna
+    legacy_hashes = [
+        h for h in _legacy_by_name.get(prod["name"], []) if h in seen_products and h not in reserved_hashes
+    ]
+    if not legacy_hashes:
+        return None
+    was_available = False
+    for legacy_hash in legacy_hashes:
+        del seen_products[legacy_hash]
+        if available_products.pop(legacy_hash, None) is not None:
+            was_available = True
+    entry = new_entry(prod)
+    entry["state"] = None  # okänt tidigare tillstånd
+    seen_products[prod["hash"]] = entry
+    if was_available:
+        available_products[prod["hash"]] = prod["name"]
+    print(f"[STATE] Slog ihop {len(legacy_hashes)} gamla poster för '{prod['name']}'.", flush=True)
+    return entry
+
+
+def compact(seen_products, available_products, retention_days=SEEN_RETENTION_DAYS):
+    """Tar bort produkter som inte setts på retention_days dagar. Returnerar antalet borttagna."""
+    cutoff = time.strftime("%Y-%m-%d", time.gmtime(time.time() - retention_days * 86400))
+    stale = [h for h, entry in seen_products.items() if entry.get("last_seen", "") < cutoff]
+    for prod_hash in stale:
+        del seen_products[prod_hash]
+        available_products.pop(prod_hash, None)
+    if stale:
+        print(f"[STATE] Tog bort {len(stale)} produkter som inte setts på {retention_days} dagar.", flush=True)
+    return len(stale)
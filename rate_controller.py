@@ -0,0 +1,263 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+from browser_state import domain_of
+
+DATA_DIR = "data"
+RATE_LIMITS_FILE = os.path.join(DATA_DIR, "rate_limits.json")
+
+INITIAL_LIMIT = 3            # samtidiga sidor per domän innan vi vet något (tidigare PARALLEL_URLS_PER_SITE)
+MAX_LIMIT = 8                # tak även för toleranta butiker
+ADDITIVE_STEP = 1.0          # ungefär +1 samtidig sida per "limit" lyckade svar
+DECREASE_FACTOR = 0.5        # multiplikativ backoff
+MIN_INTERVAL = 0.0           # sekunder mellan två starter mot samma domän
+MAX_INTERVAL = 10.0
+INTERVAL_STEP = 0.1          # additiv minskning av intervallet när allt går bra
+BACKOFF_COOLDOWN = 10.0      # flera fel i samma skur räknas som en enda backoff
+LATENCY_SPIKE_FACTOR = 3.0   # svarstid över 3x snittet räknas som överbelastning
+LATENCY_MIN_SAMPLES = 3
+EWMA_ALPHA = 0.2
+# Svarstider jämförs bara med samma sorts mätning: sidladdning, produktsida och fetch() tar olika lång tid
+LATENCY_KINDS = ("listing", "product", "fetch")
+
+THROTTLE_STATUSES = {429, 503}
+CAPTCHA_MARKERS = [
+    "captcha", "cf-challenge", "challenge-platform", "are you a robot", "verify you are human",
+]
+
+_controllers = {}
+_saved_limits = None
+
+
+def looks_like_captcha(html):
+    html = (html or "").lower()
+    return any(marker in html for marker in CAPTCHA_MARKERS)
+
+
+class DomainRateController:
+    """
+    AIMD-styrd samtidighet och takt för en domän.
+    Friska svar höjer gränsen additivt; 429/503, captcha, tomma produktlistor och
+    svarstidstoppar halverar den och ökar intervallet mellan förfrågningar.
+    """
+
+    def __init__(self, domain, limit=INITIAL_LIMIT, min_interval=MIN_INTERVAL,
+                 latency=None, max_limit=MAX_LIMIT, backoff_cooldown=BACKOFF_COOLDOWN):
+        self.domain = domain
+        self.max_limit = max(1, max_limit)
+        self.limit = min(max(1.0, float(limit)), self.max_limit)
+        self.min_interval = min(max(MIN_INTERVAL, float(min_interval)), MAX_INTERVAL)
+        # kind -> {"avg": sekunder, "samples": antal}
+        self.latency = {kind: dict(v) for kind, v in (latency or {}).items() if kind in LATENCY_KINDS}
+        self.backoff_cooldown = backoff_cooldown
+        self.in_flight = 0
+        self._next_start = 0.0
+        self._last_backoff = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while self.in_flight >= int(self.limit):
+                await self._cond.wait()
+            self.in_flight += 1
+            now = time.monotonic()
+            start_at = max(now, self._next_start)
+            self._next_start = start_at + self.min_interval
+        if start_at > now:
+            try:
+                await asyncio.sleep(start_at - now)
+            except asyncio.CancelledError:
+                # Avbruten (t.ex. av en timeout) innan förfrågan startade: lämna tillbaka platsen
+                await self.release()
+                raise
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield self
+        finally:
+            await self.release()
+
+    def record(self, status=None, latency=None, kind="listing", captcha=False, empty=False, timeout=False):
+        """
+        Rapporterar utfallet av en förfrågan och justerar gränserna.
+        latency är ren svarstid (goto/fetch), och kind anger vilken sorts mätning den är.
+        """
+        stats = self.latency.get(kind)
+        spike = (
+            latency is not None and stats is not None
+            and stats["samples"] >= LATENCY_MIN_SAMPLES
+            and latency > LATENCY_SPIKE_FACTOR * stats["avg"]
+        )
+        if latency is not None and not timeout:
+            if stats is None:
+                self.latency[kind] = {"avg": latency, "samples": 1}
+            else:
+                stats["avg"] = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * stats["avg"]
+                stats["samples"] += 1
+        if status in THROTTLE_STATUSES or captcha or empty or timeout or spike:
+            self._back_off(status=status, captcha=captcha, empty=empty, timeout=timeout, spike=spike)
+        else:
+            self._increase()
+
+    def _increase(self):
+        old = int(self.limit)
+        self.limit = min(self.max_limit, self.limit + ADDITIVE_STEP / self.limit)
+        self.min_interval = max(MIN_INTERVAL, self.min_interval - INTERVAL_STEP)
+        if int(self.limit) > old:
+            asyncio.ensure_future(self._wake())
+
+    async def _wake(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def _back_off(self, **reasons):
+        now = time.monotonic()
+        if now - self._last_backoff < self.backoff_cooldown:
+            return
+        self._last_backoff = now
+        self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+        self.min_interval = min(MAX_INTERVAL, max(self.min_interval * 2, 0.5))
+        why = ", ".join(k if v is True else f"{k}={v}" for k, v in reasons.items() if v)
+        print(f"[RATE] {self.domain}: backoff ({why}) -> {int(self.limit)} samtidiga, "
+              f"{self.min_interval:.1f} s mellan förfrågningar", flush=True)
+
+    def to_dict(self):
+        return {
+            "limit": round(self.limit, 2),
+            "min_interval": round(self.min_interval, 2),
+            "latency": {
+                kind: {"avg": round(v["avg"], 3), "samples": v["samples"]} for kind, v in self.latency.items()
+            },
+        }
+
+
+def _load_saved_limits():
+    global _saved_limits
+    if _saved_limits is None:
+        _saved_limits = {}
+        if os.path.exists(RATE_LIMITS_FILE):
+            with open(RATE_LIMITS_FILE, "r", encoding="utf-8") as f:
+                _saved_limits = json.load(f)
+    return _saved_limits
+
+
+def get_controller(url, max_limit=None):
+    """Delad kontroller för URL:ens domän, startad från förra körningens inlärda gränser."""
+    domain = domain_of(url)
+    controller = _controllers.get(domain)
+    if controller is None:
+        saved = _load_saved_limits().get(domain, {})
+        controller = DomainRateController(
+            domain,
+            limit=saved.get("limit", INITIAL_LIMIT),
+            min_interval=saved.get("min_interval", MIN_INTERVAL),
+            latency=saved.get("latency"),
+            max_limit=int(max_limit) if max_limit else MAX_LIMIT,
+        )
+        _controllers[domain] = controller
+    return controller
+
+
+def save_rate_limits():
+    limits = dict(_load_saved_limits())
+    for domain, controller in _controllers.items():
+        limits[domain] = controller.to_dict()
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(RATE_LIMITS_FILE, "w", encoding="utf-8") as f:
+        json.dump(limits, f, ensure_ascii=False, indent=2)
+
+
+async def _simulate(capacity, duration, workers):
+    from aiohttp import web
+
+    # Lokal ersättare för en butik: över `capacity` samtidiga förfrågningar svarar den 429,
+    # och svarstiden växer med lasten som hos en överbelastad server
+    active = 0
+
+    async def handle(request):
+        nonlocal active
+        active += 1
+        try:
+            if active > capacity:
+                return web.Response(status=429)
+            await asyncio.sleep(0.05 * (1 + active / capacity))
+            return web.Response(text="<div class='product'>ok</div>")
+        finally:
+            active -= 1
+
+    app = web.Application()
+    app.router.add_get("/", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/"
+
+    controller = DomainRateController("simulated", limit=1, max_limit=capacity * 3, backoff_cooldown=0.2)
+    counts = {"ok": 0, "throttled": 0}
+    trace = []
+    stop_at = time.monotonic() + duration
+    async with aiohttp.ClientSession() as session:
+        async def worker():
+            while time.monotonic() < stop_at:
+                async with controller.slot():
+                    started = time.monotonic()
+                    async with session.get(url) as response:
+                        await response.read()
+                    controller.record(status=response.status, latency=time.monotonic() - started, kind="fetch")
+                counts["ok" if response.status == 200 else "throttled"] += 1
+
+        async def sample():
+            while time.monotonic() < stop_at:
+                trace.append(int(controller.limit))
+                await asyncio.sleep(0.5)
+
+        await asyncio.gather(sample(), *(worker() for _ in range(workers)))
+    await runner.cleanup()
+    return controller, counts, trace
+
+
+async def _check_latency_kinds():
+    # Snabba fetch()-svar får inte göra en frisk, långsammare sidladdning till en svarstidstopp
+    controller = DomainRateController("kinds", limit=4)
+    for _ in range(5):
+        controller.record(status=200, latency=0.3, kind="fetch")
+    controller.record(status=200, latency=9.0, kind="listing")
+    return int(controller.limit) >= 4
+
+
+def simulate(capacity=4, duration=10, workers=12):
+    """Kör AIMD-logiken mot en lokal server som stryper över `capacity`: python rate_controller.py"""
+    controller, counts, trace = asyncio.run(_simulate(capacity, duration, workers))
+    total = counts["ok"] + counts["throttled"]
+    throttled_share = counts["throttled"] / max(total, 1)
+    print(f"Gräns över tid: {trace}")
+    print(f"{total} förfrågningar, {counts['throttled']} strypta ({throttled_share:.1%}), "
+          f"slutlig gräns {int(controller.limit)}, intervall {controller.min_interval:.1f} s")
+    checks = {
+        "gränsen växer mot kapaciteten": max(trace) >= capacity,
+        "gränsen hålls nära kapaciteten": int(controller.limit) <= capacity * 2,
+        "få strypta förfrågningar": throttled_share < 0.2,
+        "svarstider jämförs per sort": asyncio.run(_check_latency_kinds()),
+    }
+    for name, ok in checks.items():
+        print(f"{'OK ' if ok else 'FEL'} {name}")
+    return all(checks.values())
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(0 if simulate() else 1)
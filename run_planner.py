@@ -0,0 +1,97 @@
+import json
+import os
+import time
+
+DATA_DIR = "data"
+SITE_STATS_FILE = os.path.join(DATA_DIR, "site_stats.json")
+
+DEFAULT_SITE_COST = 120      # sekunder, antagen kostnad för en site utan historik
+MIN_SITE_SLICE = 60          # minsta tidsfönster en site får
+SLICE_FACTOR = 2.0           # marginal över uppskattad kostnad
+EWMA_ALPHA = 0.3             # vikt för senaste körningen i glidande medelvärde
+POST_SCRAPE_RESERVE = 600    # sekunder som reserveras för notiser, state och Sheets
+
+
+def load_site_stats():
+    if os.path.exists(SITE_STATS_FILE):
+        with open(SITE_STATS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def save_site_stats(stats):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(SITE_STATS_FILE, "w", encoding="utf-8") as f:
+        json.dump(stats, f, ensure_ascii=False, indent=2)
+
+
+def site_key(site):
+    return " ".join((site.get("name") or "").lower().split())
+
+
+def _ewma(old, new):
+    if old is None:
+        return new
+    return EWMA_ALPHA * new + (1 - EWMA_ALPHA) * old
+
+
+def estimate_cost(site, stats):
+    """Uppskattad körtid i sekunder för en site, baserat på tidigare körningar."""
+    entry = stats.get(site_key(site))
+    if not entry or entry.get("avg_duration") is None:
+        return DEFAULT_SITE_COST
+    # En site som timeade ut förra gången är troligen dyrare än vi mätte
+    if entry.get("last_outcome") == "timeout":
+        return max(entry["avg_duration"], entry.get("last_slice", DEFAULT_SITE_COST))
+    return entry["avg_duration"]
+
+
+def estimate_value(site, stats):
+    """Hur mycket en site brukar ge: notiser väger tyngst, därefter antal matchande produkter."""
+    entry = stats.get(site_key(site))
+    if not entry:
+        # Okända siter prioriteras så att vi snabbt får historik för dem
+        return 10.0
+    return 1.0 + 5.0 * entry.get("avg_alerts", 0.0) + 0.1 * entry.get("avg_products", 0.0)
+
+
+def plan_sites(sites, stats, deadline, now=None, max_site_timeout=None):
+    """
+    Sorterar sites efter värde per sekund (högst först) och ger varje site ett tidsfönster.
+    Returnerar en lista av (site, slice_seconds).
+    """
+    now = time.time() if now is None else now
+    remaining = max(0.0, deadline - now)
+    ranked = sorted(
+        sites,
+        key=lambda s: estimate_value(s, stats) / max(estimate_cost(s, stats), 1.0),
+        reverse=True,
+    )
+    plan = []
+    for site in ranked:
+        slice_ = max(MIN_SITE_SLICE, estimate_cost(site, stats) * SLICE_FACTOR)
+        if max_site_timeout:
+            slice_ = min(slice_, max_site_timeout)
+        plan.append((site, min(slice_, remaining)))
+    return plan
+
+
+def record_site_run(stats, site, duration, outcome, product_count=0, alert_count=0, slice_=None):
+    """
+    Uppdaterar statistiken för en site efter en körning. outcome: 'ok', 'timeout', 'skipped' eller
+    'cached' (genomsökningen återanvändes från sitemap-cachen och säger inget om sitens kostnad).
+    """
+    key = site_key(site)
+    if not key or outcome in ("skipped", "cached"):
+        return
+    entry = stats.setdefault(key, {})
+    # Även en timeout säger något om kostnaden: siten behövde minst så här lång tid
+    entry["avg_duration"] = _ewma(entry.get("avg_duration"), duration)
+    if outcome == "ok":
+        entry["avg_products"] = _ewma(entry.get("avg_products"), product_count)
+        entry["avg_alerts"] = _ewma(entry.get("avg_alerts"), alert_count)
+    entry["last_outcome"] = outcome
+    entry["last_duration"] = round(duration, 2)
+    if slice_ is not None:
+        entry["last_slice"] = round(slice_, 2)
+    entry["last_run"] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
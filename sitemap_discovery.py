@@ -0,0 +1,216 @@
+import copy
+import json
+import os
+import re
+import time
+import zlib
+import xml.etree.ElementTree as ET
+
+import aiohttp
+
+DATA_DIR = "data"
+SITEMAPS_FILE = os.path.join(DATA_DIR, "sitemaps.json")
+
+SITEMAP_TIMEOUT = 60             # sekunder per sitemap-fil
+CHUNK_SIZE = 64 * 1024
+MAX_NESTED_SITEMAPS = 50         # skydd mot oändliga/enorma sitemap-index
+MAX_CHANGED_URLS = 25            # fler ändringar än så hanteras av den vanliga genomsökningen
+DEFAULT_SKIP_CRAWL_HOURS = 0     # 0 = genomsök alltid listningssidorna
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/114.0.0.0 Safari/537.36 Edg/114.0.1823.43"
+)
+
+_state = None
+
+
+def _load_state():
+    global _state
+    if _state is None:
+        _state = {}
+        if os.path.exists(SITEMAPS_FILE):
+            with open(SITEMAPS_FILE, "r", encoding="utf-8") as f:
+                _state = json.load(f)
+    return _state
+
+
+def save_state():
+    if _state is None:
+        return
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(SITEMAPS_FILE, "w", encoding="utf-8") as f:
+        json.dump(_state, f, ensure_ascii=False, indent=2)
+
+
+def _site_state(site):
+    key = " ".join((site.get("name") or "").lower().split())
+    return _load_state().setdefault(key, {"urls": {}, "sitemaps": {}})
+
+
+def sitemap_urls(site):
+    value = site.get("sitemap_url")
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+async def _stream_sitemap(session, url, validators):
+    """
+    Hämtar en sitemap som ström och parsar den inkrementellt.
+    Returnerar (entries, child_sitemaps, nya validators), eller None om servern svarade 304.
+    entries och child_sitemaps är listor av (loc, lastmod).
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    timeout = aiohttp.ClientTimeout(total=SITEMAP_TIMEOUT)
+    async with session.get(url, headers=headers, timeout=timeout) as response:
+        if response.status == 304:
+            return None
+        response.raise_for_status()
+        parser = ET.XMLPullParser(events=("end",))
+        decompressor = None
+        first = True
+        entries, children = [], []
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            if first:
+                # .xml.gz-filer skickas ofta som rå gzip utan Content-Encoding
+                if chunk[:2] == b"\x1f\x8b":
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                first = False
+            parser.feed(decompressor.decompress(chunk) if decompressor else chunk)
+            _drain(parser, entries, children)
+        if decompressor:
+            parser.feed(decompressor.flush())
+        parser.close()
+        _drain(parser, entries, children)
+        new_validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+    return entries, children, new_validators
+
+
+def _drain(parser, entries, children):
+    for _, elem in parser.read_events():
+        tag = _local(elem.tag)
+        if tag not in ("url", "sitemap"):
+            continue
+        loc = lastmod = None
+        for child in elem:
+            name = _local(child.tag)
+            if name == "loc":
+                loc = (child.text or "").strip()
+            elif name == "lastmod":
+                lastmod = (child.text or "").strip()
+        if loc:
+            (entries if tag == "url" else children).append((loc, lastmod))
+        # Släpp det parsade elementet så att minnet inte växer med filens storlek
+        elem.clear()
+
+
+def _restore_locs(state, sitemap_url, seen_urls, recurse, depth=0):
+    sm_state = state["sitemaps"].get(sitemap_url, {})
+    for loc in sm_state.get("locs", []):
+        if loc in state["urls"]:
+            seen_urls[loc] = state["urls"][loc]
+    if recurse and depth < MAX_NESTED_SITEMAPS:
+        for child_url in sm_state.get("children", []):
+            _restore_locs(state, child_url, seen_urls, recurse, depth + 1)
+
+
+async def discover_changes(site):
+    """
+    Jämför sitens sitemap(s) med förra körningen.
+    Returnerar en lista med URL:er som är nya eller har ändrad lastmod,
+    eller None om siten saknar sitemap eller inte kunde läsas.
+    Första körningen sparar bara en baslinje och returnerar en tom lista.
+    """
+    roots = sitemap_urls(site)
+    if not roots:
+        return None
+    site_state = _site_state(site)
+    # Arbeta på en kopia så att en avbruten hämtning inte lämnar halvuppdaterat state
+    state = copy.deepcopy(site_state)
+    url_filter = re.compile(site["sitemap_url_filter"]) if site.get("sitemap_url_filter") else None
+    baseline = not state["urls"]
+    seen_urls = {}
+    changed = []
+    queue = list(roots)
+    fetched = 0
+    try:
+        async with aiohttp.ClientSession(headers={"User-Agent": USER_AGENT}) as session:
+            while queue and fetched < MAX_NESTED_SITEMAPS:
+                sitemap_url = queue.pop(0)
+                fetched += 1
+                sm_state = state["sitemaps"].setdefault(sitemap_url, {})
+                result = await _stream_sitemap(session, sitemap_url, sm_state)
+                if result is None:
+                    # Oförändrad fil: behåll dess URL:er, men barnen kan ha ändrats på egen hand
+                    _restore_locs(state, sitemap_url, seen_urls, recurse=False)
+                    queue.extend(sm_state.get("children", []))
+                    continue
+                entries, children, validators = result
+                sm_state.update(validators)
+                sm_state["children"] = [child_url for child_url, _ in children]
+                for child_url, child_lastmod in children:
+                    child_state = state["sitemaps"].setdefault(child_url, {})
+                    if child_lastmod and child_state.get("lastmod") == child_lastmod:
+                        _restore_locs(state, child_url, seen_urls, recurse=True)
+                        continue
+                    child_state["lastmod"] = child_lastmod
+                    queue.append(child_url)
+                locs = []
+                for loc, lastmod in entries:
+                    if url_filter and not url_filter.search(loc):
+                        continue
+                    locs.append(loc)
+                    seen_urls[loc] = lastmod
+                    if loc not in state["urls"] or (lastmod and state["urls"][loc] != lastmod):
+                        changed.append(loc)
+                sm_state["locs"] = locs
+    except Exception as e:
+        print(f"[SITEMAP] Kunde inte läsa sitemap för {site.get('name')}: {e}", flush=True)
+        return None
+    if queue:
+        print(f"[SITEMAP] {site.get('name')}: fler än {MAX_NESTED_SITEMAPS} sitemaps, resten hoppas över.", flush=True)
+        for sitemap_url in queue:
+            _restore_locs(state, sitemap_url, seen_urls, recurse=True)
+    state["urls"] = seen_urls
+    state.pop("last_discovery", None)
+    site_state.clear()
+    site_state.update(state)
+    if baseline:
+        print(f"[SITEMAP] {site.get('name')}: baslinje med {len(seen_urls)} URL:er sparad.", flush=True)
+        return []
+    print(f"[SITEMAP] {site.get('name')}: {len(changed)} nya/ändrade URL:er av {len(seen_urls)}.", flush=True)
+    return changed[:MAX_CHANGED_URLS]
+
+
+def can_skip_crawl(site, changed):
+    """True om listningssidorna inte behöver genomsökas: inga ändringar och en färsk cache finns."""
+    hours = float(site.get("sitemap_skip_crawl_hours", DEFAULT_SKIP_CRAWL_HOURS) or 0)
+    if changed is None or changed or hours <= 0:
+        return False
+    state = _site_state(site)
+    return "products" in state and time.time() - state.get("last_crawl", 0) < hours * 3600
+
+
+def cached_products(site):
+    return list(_site_state(site).get("products", []))
+
+
+def remember_crawl(site, products):
+    state = _site_state(site)
+    state["products"] = products
+    state["last_crawl"] = time.time()
@@ -0,0 +1,292 @@
+import asyncio
+import json
+import os
+import re
+import time
+
+import aiohttp
+
+SUBSCRIPTIONS_FILE = "subscriptions.json"
+DISCORD_SEND_INTERVAL = 1.5  # sekunder mellan meddelanden till samma webhook
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+def parse_price(value):
+    """'1 299,00 kr' -> 1299.0. Returnerar None om inget pris kan tolkas."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    digits = re.sub(r"[^\d,.]", "", str(value))
+    if not digits:
+        return None
+    # Sista skiljetecknet följt av 1-2 siffror är decimaler, övriga är tusentalsavgränsare
+    match = re.match(r"^(.*?)[,.](\d{1,2})$", digits)
+    if match:
+        whole, decimals = match.group(1), match.group(2)
+    else:
+        whole, decimals = digits, "0"
+    whole = re.sub(r"[,.]", "", whole)
+    try:
+        return float(f"{whole or '0'}.{decimals}")
+    except ValueError:
+        return None
+
+
+def _phrase_in_tokens(phrase_tokens, name_tokens):
+    n = len(phrase_tokens)
+    return any(name_tokens[i:i + n] == phrase_tokens for i in range(len(name_tokens) - n + 1))
+
+
+def default_subscription(webhook, keywords, blocked_keywords):
+    """Den ursprungliga globala prenumerationen: DISCORD_WEBHOOK + KEYWORDS/BLOCKED_KEYWORDS."""
+    return {
+        "name": "default",
+        "webhook": webhook,
+        "keywords": list(keywords),
+        "blocked_keywords": list(blocked_keywords),
+        "respect_site_skip_keywords": True,
+        # Samma delsträngsmatchning som product_matches_keywords, så att scrapning och utskick är överens
+        "keyword_match": "substring",
+    }
+
+
+def load_subscriptions(default=None):
+    """
+    Läser prenumerationer från miljövariabeln SUBSCRIPTIONS (JSON) eller subscriptions.json.
+    Varje prenumeration kan ha: name, webhook eller webhook_env, keywords, blocked_keywords,
+    sites, statuses, min_price, max_price, respect_site_skip_keywords och keyword_match
+    ('phrase', standard: hela ord/fraser, eller 'substring': nyckelorden söks som reguljära uttryck i namnet).
+    """
+    raw = os.getenv("SUBSCRIPTIONS")
+    subs = []
+    try:
+        if raw:
+            subs = json.loads(raw)
+        elif os.path.exists(SUBSCRIPTIONS_FILE):
+            with open(SUBSCRIPTIONS_FILE, "r", encoding="utf-8") as f:
+                subs = json.load(f)
+    except json.JSONDecodeError as e:
+        print(f"❌ Fel i prenumerationsformatet: {e}", flush=True)
+        subs = []
+    valid = []
+    for sub in subs:
+        # Webhooks är hemligheter, så de kan pekas ut via en miljövariabel istället för att checkas in
+        if not sub.get("webhook") and sub.get("webhook_env"):
+            sub["webhook"] = os.getenv(sub["webhook_env"])
+        if not sub.get("webhook"):
+            print(f"[SUBSCRIPTIONS] Hoppar över {sub.get('name', '?')}: ingen webhook.", flush=True)
+            continue
+        valid.append(sub)
+    if default and default.get("webhook"):
+        valid.insert(0, default)
+    return valid
+
+
+class SubscriptionIndex:
+    """
+    Prenumerationer kompilerade till inverterade index över site, status och nyckelordstoken.
+    Ett event matchas genom att snitta kandidatmängderna och bara verifiera de få som återstår,
+    istället för att gå igenom varje prenumerations alla filter.
+    """
+
+    def __init__(self, subscriptions):
+        self.subscriptions = list(subscriptions)
+        self._by_site, self._any_site = {}, set()
+        self._by_status, self._any_status = {}, set()
+        self._by_token, self._any_keyword = {}, set()
+        self._without_keywords = set()
+        self._keywords = []
+        self._patterns = {}
+        self._blocked = []
+        self._skip_aware = set()
+        self._price_bounds = []
+        for i, sub in enumerate(self.subscriptions):
+            self._add_values(i, sub.get("sites"), self._by_site, self._any_site)
+            self._add_values(i, sub.get("statuses"), self._by_status, self._any_status)
+            phrases = [tokenize(k) for k in sub.get("keywords") or []]
+            phrases = [p for p in phrases if p]
+            self._keywords.append(phrases)
+            self._blocked.append([b.lower() for b in sub.get("blocked_keywords") or []])
+            if phrases and sub.get("keyword_match") == "substring":
+                # Delsträngar kan inte slås upp per token, så de verifieras för varje event
+                self._patterns[i] = [re.compile(k, re.IGNORECASE) for k in sub.get("keywords") if k]
+                self._any_keyword.add(i)
+            elif phrases:
+                for phrase in phrases:
+                    # Längsta token är oftast den mest selektiva
+                    self._by_token.setdefault(max(phrase, key=len), set()).add(i)
+            else:
+                self._any_keyword.add(i)
+                self._without_keywords.add(i)
+            if sub.get("respect_site_skip_keywords"):
+                self._skip_aware.add(i)
+            self._price_bounds.append((parse_price(sub.get("min_price")), parse_price(sub.get("max_price"))))
+
+    @staticmethod
+    def _add_values(i, values, index, wildcard):
+        if not values:
+            wildcard.add(i)
+            return
+        if isinstance(values, str):
+            values = [values]
+        for value in values:
+            index.setdefault(" ".join(str(value).lower().split()), set()).add(i)
+
+    def _keyword_candidates(self, name_tokens):
+        candidates = set(self._any_keyword)
+        for token in set(name_tokens):
+            candidates |= self._by_token.get(token, set())
+        return candidates
+
+    def _passes_keywords(self, i, name_lower, name_tokens):
+        if i in self._patterns:
+            return any(p.search(name_lower) for p in self._patterns[i])
+        phrases = self._keywords[i]
+        return not phrases or any(_phrase_in_tokens(p, name_tokens) for p in phrases)
+
+    def _is_blocked(self, i, name_lower):
+        return any(b in name_lower for b in self._blocked[i])
+
+    def _site_candidates(self, site_name):
+        return self._by_site.get(" ".join((site_name or "").lower().split()), set()) | self._any_site
+
+    def matches_keywords(self, name, site_name=None):
+        """
+        True om minst en prenumeration som bevakar siten vill ha produktnamnet (används vid scrapning).
+        Prenumerationer utan nyckelord vidgar inte scrapningen: de får det som ändå behålls.
+        """
+        name_lower = (name or "").lower()
+        name_tokens = tokenize(name_lower)
+        candidates = (self._keyword_candidates(name_tokens) - self._without_keywords) & self._site_candidates(site_name)
+        return any(
+            self._passes_keywords(i, name_lower, name_tokens) and not self._is_blocked(i, name_lower)
+            for i in candidates
+        )
+
+    def match(self, event):
+        """Returnerar prenumerationerna som ska ha eventet (dict med name, site_name, status, price)."""
+        # Grupperade events matchar site-filtret för butikerna som ändrats, inte övriga erbjudanden
+        site_names = event.get("changed_sites") or [event.get("site_name")]
+        site_candidates = set()
+        for site_name in site_names:
+            site_candidates |= self._site_candidates(site_name)
+        status = " ".join((event.get("status") or "").lower().split())
+        candidates = site_candidates & (self._by_status.get(status, set()) | self._any_status)
+        if not candidates:
+            return []
+        name_lower = (event.get("name") or "").lower()
+        name_tokens = tokenize(name_lower)
+        keyword_ok = self._keyword_candidates(name_tokens)
+        if event.get("skip_keywords"):
+            keyword_ok |= self._skip_aware
+        price = None
+        matched = []
+        for i in sorted(candidates & keyword_ok):
+            sub = self.subscriptions[i]
+            # Precis som vid scrapning gäller skip_keywords både nyckelord och blockerade ord
+            if not (event.get("skip_keywords") and i in self._skip_aware):
+                if not self._passes_keywords(i, name_lower, name_tokens) or self._is_blocked(i, name_lower):
+                    continue
+            min_price, max_price = self._price_bounds[i]
+            if min_price is not None or max_price is not None:
+                if price is None:
+                    price = parse_price(event.get("price"))
+                if price is None:
+                    continue
+                if min_price is not None and price < min_price:
+                    continue
+                if max_price is not None and price > max_price:
+                    continue
+            matched.append(sub)
+        return matched
+
+
+async def _webhook_worker(session, webhook, queue, send, delivered):
+    while True:
+        payload = await queue.get()
+        try:
+            if await send(session, webhook, payload):
+                delivered[webhook] = delivered.get(webhook, 0) + 1
+        finally:
+            queue.task_done()
+        await asyncio.sleep(DISCORD_SEND_INTERVAL)
+
+
+async def dispatch(events, index, build_payload, send):
+    """
+    Matchar alla events mot indexet och levererar via en kö per webhook.
+    Webhooks skickas parallellt, men varje webhook får sina meddelanden i ordning och i jämn takt.
+    send(session, webhook, payload) returnerar True när meddelandet levererats.
+    Returnerar antalet levererade meddelanden.
+    """
+    queues = {}
+    for event in events:
+        payload = build_payload(event)
+        if payload is None:
+            continue
+        # Flera prenumerationer kan dela webhook, men varje webhook ska bara få eventet en gång
+        for webhook in dict.fromkeys(sub["webhook"] for sub in index.match(event)):
+            queues.setdefault(webhook, asyncio.Queue()).put_nowait(payload)
+    if not queues:
+        return 0
+    queued = sum(q.qsize() for q in queues.values())
+    delivered = {}
+    async with aiohttp.ClientSession() as session:
+        workers = [
+            asyncio.create_task(_webhook_worker(session, webhook, queue, send, delivered))
+            for webhook, queue in queues.items()
+        ]
+        await asyncio.gather(*(queue.join() for queue in queues.values()))
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    sent = sum(delivered.values())
+    if sent < queued:
+        print(f"[DISCORD] {queued - sent} av {queued} meddelanden kunde inte levereras.", flush=True)
+    return sent
+
+
+def benchmark(subscription_count=1000, event_count=2000):
+    """Mäter matchningskostnaden: python subscriptions.py"""
+    import random
+    rnd = random.Random(42)
+    words = ["pokemon", "destined", "rivals", "prismatic", "evolutions", "journey", "together",
+             "black", "bolt", "white", "flare", "booster", "display", "elite", "trainer", "box",
+             "tin", "blister", "bundle", "collection", "premium", "league", "battle", "deck"]
+    sites = ["webhallen", "mystery shack", "world of board games", "alphaspel", "spelexperten"]
+    statuses = ["Ny produkt", "Tillbaka i lager", "Förbeställningsbar"]
+    subs = []
+    for i in range(subscription_count):
+        subs.append({
+            "name": f"sub{i}",
+            "webhook": f"https://example.invalid/{i % 50}",
+            "keywords": [" ".join(rnd.sample(words, rnd.randint(1, 2))) for _ in range(rnd.randint(1, 4))],
+            "blocked_keywords": rnd.sample(["binder", "sleeves", "playmat"], rnd.randint(0, 2)),
+            "sites": rnd.sample(sites, rnd.randint(0, 2)),
+            "statuses": rnd.sample(statuses, rnd.randint(0, 2)),
+            "max_price": rnd.choice([None, 500, 1500, 3000]),
+        })
+    events = [{
+        "name": " ".join(rnd.sample(words, 5)),
+        "site_name": rnd.choice(sites),
+        "status": rnd.choice(statuses),
+        "price": f"{rnd.randint(49, 4000)} kr",
+    } for _ in range(event_count)]
+    start = time.perf_counter()
+    index = SubscriptionIndex(subs)
+    built = time.perf_counter()
+    matches = sum(len(index.match(e)) for e in events)
+    done = time.perf_counter()
+    print(f"Index för {subscription_count} prenumerationer byggt på {(built - start) * 1000:.1f} ms")
+    print(f"{event_count} events matchade på {(done - built) * 1000:.1f} ms "
+          f"({(done - built) / event_count * 1e6:.1f} µs/event, {matches} leveranser)")
+
+
+if __name__ == "__main__":
+    benchmark()
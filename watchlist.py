@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+
+import aiohttp
+
+from api_scraper import deep_get
+from browser_state import domain_of, new_site_context
+
+DATA_DIR = "data"
+WATCHLIST_FILE = "watchlist.json"
+WATCHLIST_STATE_FILE = os.path.join(DATA_DIR, "watchlist_state.json")
+
+DEFAULT_INTERVAL = 15      # sekunder mellan kontroller av samma produkt
+MIN_INTERVAL = 5
+PROBE_TIMEOUT = 20
+JITTER = 0.2               # ±20 % så att produkter på samma domän inte kontrolleras i takt
+
+IN_STOCK = "Tillbaka i lager"
+PREORDER = "Förbeställningsbar"
+OUT_OF_STOCK = "slutsåld"
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/114.0.0.0 Safari/537.36 Edg/114.0.1823.43"
+)
+
+
+def load_watchlist():
+    """
+    Läser bevakningslistan från miljövariabeln WATCHLIST (JSON) eller watchlist.json.
+    Varje post: url, site, name (krävs om produkten inte redan hittats av genomsökningen), interval, probe ('json', 'http' eller 'page'; annars väljs
+    den billigaste som går), json_url, json_available_key, json_preorder_key, json_price_key,
+    json_title_key, in_stock_pattern, out_of_stock_pattern, buy_button_selector.
+    """
+    raw = os.getenv("WATCHLIST")
+    try:
+        if raw:
+            return json.loads(raw)
+        if os.path.exists(WATCHLIST_FILE):
+            with open(WATCHLIST_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+    except json.JSONDecodeError as e:
+        print(f"❌ Fel i watchlist-formatet: {e}", flush=True)
+    return []
+
+
+def load_state():
+    if os.path.exists(WATCHLIST_STATE_FILE):
+        with open(WATCHLIST_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(WATCHLIST_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+
+
+def choose_probe(entry):
+    """Billigaste sonden först: butikens JSON, sedan villkorlig GET, sist en riktig sida."""
+    if entry.get("probe"):
+        return entry["probe"]
+    if entry.get("json_url") or "/products/" in entry["url"]:
+        return "json"
+    if entry.get("in_stock_pattern") or entry.get("out_of_stock_pattern"):
+        return "http"
+    return "page"
+
+
+def _json_url(entry):
+    if entry.get("json_url"):
+        return entry["json_url"]
+    # Shopify: /products/<handle>.js ger tillgänglighet och pris utan att rendera sidan
+    return entry["url"].split("?")[0].rstrip("/") + ".js"
+
+
+async def probe_json(session, entry, state):
+    async with session.get(_json_url(entry), timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as response:
+        response.raise_for_status()
+        data = await response.json(content_type=None)
+    available = deep_get(data, entry.get("json_available_key", "available"))
+    preorder = deep_get(data, entry["json_preorder_key"]) if entry.get("json_preorder_key") else None
+    price = deep_get(data, entry.get("json_price_key", "price"))
+    if isinstance(price, (int, float)) and not entry.get("json_price_key"):
+        price = f"{price / 100:.2f} kr"  # Shopify anger pris i ören
+    name = deep_get(data, entry.get("json_title_key", "title"))
+    status = IN_STOCK if available else (PREORDER if preorder else OUT_OF_STOCK)
+    return status, price, name
+
+
+async def probe_http(session, entry, state):
+    headers = {}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+    async with session.get(entry["url"], headers=headers,
+                           timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as response:
+        if response.status == 304:
+            return state.get("status"), state.get("price"), None
+        response.raise_for_status()
+        body = await response.text()
+        state["etag"] = response.headers.get("ETag")
+        state["last_modified"] = response.headers.get("Last-Modified")
+    body_hash = hashlib.sha256(body.encode("utf-8")).hexdigest()
+    if body_hash == state.get("body_hash"):
+        return state.get("status"), state.get("price"), None
+    state["body_hash"] = body_hash
+    if entry.get("out_of_stock_pattern") and re.search(entry["out_of_stock_pattern"], body, re.IGNORECASE):
+        return OUT_OF_STOCK, None, None
+    if entry.get("in_stock_pattern"):
+        in_stock = re.search(entry["in_stock_pattern"], body, re.IGNORECASE)
+        return (IN_STOCK if in_stock else OUT_OF_STOCK), None, None
+    return IN_STOCK, None, None
+
+
+class PagePool:
+    """En återanvänd Playwright-sida per domän, skild från genomsökningens kontexter."""
+
+    def __init__(self, browser):
+        self.browser = browser
+        self._pages = {}
+        self._locks = {}
+
+    async def probe(self, entry):
+        domain = domain_of(entry["url"])
+        lock = self._locks.setdefault(domain, asyncio.Lock())
+        async with lock:
+            page = self._pages.get(domain)
+            if page is None or page.is_closed():
+                context = await new_site_context(self.browser, entry["url"], USER_AGENT)
+                page = await context.new_page()
+                self._pages[domain] = page
+            await page.goto(entry["url"], timeout=PROBE_TIMEOUT * 1000, wait_until="domcontentloaded")
+            count = await page.locator(entry["buy_button_selector"]).count()
+        return (IN_STOCK if count > 0 else OUT_OF_STOCK), None, None
+
+    async def close(self):
+        for page in self._pages.values():
+            try:
+                await page.context.close()
+            except Exception:
+                pass
+        self._pages.clear()
+
+
+async def _watch_entry(entry, session, page_pool, state, on_change, stop_event):
+    probe = choose_probe(entry)
+    if probe == "page" and (page_pool is None or not entry.get("buy_button_selector")):
+        print(f"[WATCH] {entry['url']}: ingen billig sond och ingen buy_button_selector – hoppar över.", flush=True)
+        return
+    interval = max(MIN_INTERVAL, float(entry.get("interval", DEFAULT_INTERVAL)))
+    entry_state = state.setdefault(entry["url"], {})
+    while not stop_event.is_set():
+        started = time.monotonic()
+        try:
+            if probe == "json":
+                status, price, name = await probe_json(session, entry, entry_state)
+            elif probe == "http":
+                status, price, name = await probe_http(session, entry, entry_state)
+            else:
+                status, price, name = await page_pool.probe(entry)
+            if status and status != entry_state.get("status"):
+                previous = entry_state.get("status")
+                entry_state["status"] = status
+                entry_state["price"] = price or entry_state.get("price")
+                print(f"[WATCH] {entry.get('name') or entry['url']}: {previous} -> {status} "
+                      f"({probe}, {time.monotonic() - started:.2f} s)", flush=True)
+                await on_change(entry, status, entry_state["price"], entry.get("name") or name)
+        except Exception as e:
+            print(f"[WATCH] Fel vid kontroll av {entry['url']} ({probe}): {e}", flush=True)
+        delay = interval * random.uniform(1 - JITTER, 1 + JITTER)
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_watchlist(entries, on_change, stop_event, browser=None):
+    """
+    Kontrollerar varje bevakad produkt med några sekunders mellanrum tills stop_event sätts.
+    on_change(entry, status, price, name) anropas direkt när en produkts status ändras.
+    """
+    if not entries:
+        return
+    state = load_state()
+    page_pool = PagePool(browser) if browser else None
+    print(f"[WATCH] Bevakar {len(entries)} produkter.", flush=True)
+    try:
+        async with aiohttp.ClientSession(headers={"User-Agent": USER_AGENT}) as session:
+            await asyncio.gather(*(
+                _watch_entry(entry, session, page_pool, state, on_change, stop_event)
+                for entry in entries if entry.get("url")
+            ))
+    finally:
+        if page_pool:
+            await page_pool.close()
+        save_state(state)